@@ -0,0 +1,172 @@
+import hashlib
+from contextlib import contextmanager
+from dataclasses import dataclass
+from time import perf_counter
+from datetime import datetime
+from typing import AsyncIterable, Iterable, Iterator, Optional, Sequence, Union
+import psycopg
+from sqlalchemy import Executable, delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+from app.models import Base, Genes, LoadedDatasets, LoadingDatasets, Species, RegulatorySequences
+from app.utils import async_engine, async_session
+
+
+@dataclass
+class LoadTiming:
+    table: str
+    rows: int = 0
+    seconds: float = 0.0
+
+load_timings: list[LoadTiming] = []
+
+# Times everything inside the with block and records it so the startup report can show where the time went
+@contextmanager
+def timed(table: str) -> Iterator[LoadTiming]:
+    timing = LoadTiming(table)
+    start = perf_counter()
+    try:
+        yield timing
+    finally:
+        timing.seconds = perf_counter() - start
+        load_timings.append(timing)
+
+def print_timing_report() -> None:
+    print("table load times:")
+    for timing in sorted(load_timings, key=lambda timing: timing.seconds, reverse=True):
+        rate = timing.rows / timing.seconds if timing.seconds > 0 else 0
+        print(f"  {timing.table:<35} {timing.rows:>9} rows {timing.seconds:>8.2f}s {rate:>10.0f} rows/s")
+    print(f"  {'total':<35} {sum(timing.rows for timing in load_timings):>9} rows")
+
+# Streams rows into the table of the given model with COPY instead of sending one INSERT per row. The delete statements
+# run first in the same transaction so replacing a dataset never leaves the table half empty for anyone reading it.
+# Rows can come from an async iterable so they can be parsed while earlier ones are being written.
+async def copy_rows(model: type[Base], columns: list[str], rows: Union[Iterable[tuple], AsyncIterable[tuple]], delete: Sequence[Executable] = ()) -> int:
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    count = 0
+
+    async with async_engine.connect() as connection:
+        for statement in delete:
+            await connection.execute(statement)
+
+        # COPY is not exposed through sqlalchemy so we go through the underlying psycopg connection
+        raw_connection = (await connection.get_raw_connection()).driver_connection
+
+        async with raw_connection.cursor() as cursor:
+            async with cursor.copy(f'COPY "{model.__tablename__}" ({column_list}) FROM STDIN') as copy:
+                if isinstance(rows, AsyncIterable):
+                    async for row in rows:
+                        await copy.write_row(row)
+                        count += 1
+                else:
+                    for row in rows:
+                        await copy.write_row(row)
+                        count += 1
+
+        await raw_connection.commit()
+
+    return count
+
+async def gene_ids() -> dict[str, int]:
+    async with async_session() as session:
+        result = (await session.execute(select(Genes.name, Genes.id))).tuples().all()
+
+    return {name: id for name, id in result}
+
+async def species_ids() -> dict[str, int]:
+    async with async_session() as session:
+        result = (await session.execute(select(Species.name, Species.id))).tuples().all()
+
+    return {name: id for name, id in result}
+
+# Maps (gene name, species name) to the regulatory sequence id so rows can be resolved without a query each
+async def regulatory_sequence_ids() -> dict[tuple[str, str], int]:
+    async with async_session() as session:
+        stmt = (select(Genes.name, Species.name, RegulatorySequences.id)
+                .select_from(RegulatorySequences)
+                .join(Genes)
+                .join(Species))
+
+        result = (await session.execute(stmt)).tuples().all()
+
+    return {(gene_name, species_name): id for gene_name, species_name, id in result}
+
+
+# sha256 of the contents of every file in order, a dataset is reloaded whenever this changes
+def fingerprint(paths: Iterable[str]) -> str:
+    digest = hashlib.sha256()
+
+    for path in paths:
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+# dataset name -> fingerprint of the files it was last loaded from
+async def loaded_fingerprints() -> dict[str, str]:
+    async with async_session() as session:
+        result = (await session.execute(select(LoadedDatasets.name, LoadedDatasets.fingerprint))).tuples().all()
+
+    return {name: fingerprint for name, fingerprint in result}
+
+async def record_datasets(fingerprints: dict[str, str]) -> None:
+    async with async_session() as session:
+        stmt = insert(LoadedDatasets).values([{"name": name, "fingerprint": fingerprint, "loaded_at": func.now()} for name, fingerprint in fingerprints.items()])
+        stmt = stmt.on_conflict_do_update(index_elements=[LoadedDatasets.name], set_={"fingerprint": stmt.excluded.fingerprint, "loaded_at": stmt.excluded.loaded_at})
+
+        await session.execute(stmt)
+        await session.execute(delete(LoadingDatasets).where(LoadingDatasets.name.in_(list(fingerprints))))
+        await session.commit()
+
+# Postgres channel the server asks the loader on to load a dataset next, the payload is the dataset's name
+PRIORITY_CHANNEL = "load_priority"
+
+# dataset name -> (state, when it got it, error) of every dataset the running load hasn't finished
+async def loading_states() -> dict[str, tuple[str, datetime, Optional[str]]]:
+    async with async_session() as session:
+        result = (await session.execute(select(LoadingDatasets.name, LoadingDatasets.state, LoadingDatasets.updated_at, LoadingDatasets.error))).tuples().all()
+
+    return {name: (state, updated_at, error) for name, state, updated_at, error in result}
+
+# Replaces whatever an earlier load left in LoadingDatasets with the datasets of this one, all waiting
+async def start_loading(names: list[str]) -> None:
+    async with async_session() as session:
+        await session.execute(delete(LoadingDatasets))
+
+        for start in range(0, len(names), 1000):
+            await session.execute(insert(LoadingDatasets).values([{"name": name, "state": "waiting", "updated_at": func.now()} for name in names[start:start + 1000]]))
+
+        await session.commit()
+
+async def mark_datasets(names: list[str], state: str, error: Optional[str] = None) -> None:
+    async with async_session() as session:
+        stmt = insert(LoadingDatasets).values([{"name": name, "state": state, "updated_at": func.now(), "error": error} for name in names])
+        stmt = stmt.on_conflict_do_update(index_elements=[LoadingDatasets.name], set_={"state": stmt.excluded.state, "updated_at": stmt.excluded.updated_at, "error": stmt.excluded.error})
+
+        await session.execute(stmt)
+        await session.commit()
+
+async def request_priority(names: list[str]) -> None:
+    async with async_session() as session:
+        for name in names:
+            await session.execute(select(func.pg_notify(PRIORITY_CHANNEL, name)))
+
+        # notifications are only sent once the transaction commits
+        await session.commit()
+
+# Adds every dataset name the server asks for on PRIORITY_CHANNEL to prioritized until it is cancelled
+async def listen_for_priorities(prioritized: set[str]) -> None:
+    # LISTEN needs a connection of its own that stays in autocommit, so it is opened outside the pool
+    url = async_engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+
+    try:
+        async with await psycopg.AsyncConnection.connect(url, autocommit=True) as connection:
+            await connection.execute(f"LISTEN {PRIORITY_CHANNEL}")
+
+            async for notify in connection.notifies():
+                if notify.payload not in prioritized:
+                    print(f"loading {notify.payload} first, it has been requested")
+                    prioritized.add(notify.payload)
+    except psycopg.Error as error:
+        # the load goes on without it, datasets are just loaded in the order they were scheduled
+        print(f"couldn't listen for requested datasets: {error}")
\ No newline at end of file
@@ -0,0 +1,145 @@
+import os
+import zlib
+from typing import Optional
+
+# brotli and zstandard are in requirements.txt but the service still runs without them, those encodings just aren't offered
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compresses responses for clients that send Accept-Encoding, picking the best encoding both sides support.
+# Sequences and track payloads are mostly the same few letters and keys repeated so they shrink by 4-10x.
+
+# anything smaller isn't worth the extra work on either side
+MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+
+COMPRESSIBLE_TYPES = (b"application/json", b"text/", b"application/vnd.crg.packed")
+
+# The compressors all have the same shape, compress() returns whatever output is ready and flush() the rest
+class _GzipCompressor:
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.flush()
+
+class _BrotliCompressor:
+
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=4)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.finish()
+
+class _ZstdCompressor:
+
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.flush()
+
+# in order of preference, fastest to decompress with the best ratio first
+ENCODINGS: list[tuple[bytes, type]] = []
+if zstandard is not None:
+    ENCODINGS.append((b"zstd", _ZstdCompressor))
+if brotli is not None:
+    ENCODINGS.append((b"br", _BrotliCompressor))
+ENCODINGS.append((b"gzip", _GzipCompressor))
+
+# The first encoding we support that the client accepts, q=0 counts as refused
+def negotiate(accept_encoding: bytes) -> Optional[tuple[bytes, type]]:
+    accepted = set()
+
+    for part in accept_encoding.lower().split(b","):
+        name, _, params = part.strip().partition(b";")
+        if params.replace(b" ", b"") in (b"q=0", b"q=0.0", b"q=0.00", b"q=0.000"):
+            continue
+        accepted.add(name.strip())
+
+    for name, compressor in ENCODINGS:
+        if name in accepted or b"*" in accepted:
+            return name, compressor
+
+    return None
+
+# Plain ASGI middleware so streamed responses are compressed chunk by chunk instead of being collected first
+class CompressionMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate(dict(scope["headers"]).get(b"accept-encoding", b""))
+
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        compressor = None
+
+        async def compress_body(message):
+            nonlocal start_message, compressor
+
+            if message["type"] == "http.response.start":
+                # held back until the first body chunk shows whether the response is big enough to compress
+                start_message = message
+                return
+
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if start_message is not None:
+                headers = dict(start_message.get("headers", []))
+                content_type = headers.get(b"content-type", b"")
+
+                if (b"content-encoding" in headers or not content_type.startswith(COMPRESSIBLE_TYPES)
+                        or (not more_body and len(body) < MIN_SIZE)):
+                    await send(start_message)
+                    start_message = None
+                    await send(message)
+                    compressor = False
+                    return
+
+                compressor = encoding[1]()
+                headers = [(name, value) for name, value in start_message.get("headers", []) if name.lower() not in (b"content-length", b"vary")]
+                headers += [(b"content-encoding", encoding[0]), (b"vary", b"Accept-Encoding")]
+                await send({**start_message, "headers": headers})
+                start_message = None
+
+            if not compressor:
+                await send(message)
+                return
+
+            data = compressor.compress(body)
+            if not more_body:
+                data += compressor.flush()
+
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, compress_body)
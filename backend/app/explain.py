@@ -0,0 +1,76 @@
+import argparse
+import asyncio
+from sqlalchemy import event
+from app.utils import async_engine
+from app.routers import genes, species, regulatory_sequences, regulatory_elements, conservation_scores
+
+# Runs EXPLAIN ANALYZE on the queries the routers send for one gene/species so index changes can be compared.
+#
+#   python -m app.explain --gene DRD4 --species "Homo sapiens" [--plans]
+#
+# The statements are captured from the real router functions rather than copied here so they can't drift apart.
+# Nothing is built in memory in this process so element queries go through the database fallback in get_elements.
+
+captured: list[tuple[str, dict]] = []
+
+def capture(connection, cursor, statement, parameters, context, executemany) -> None:
+    if not statement.startswith("EXPLAIN"):
+        captured.append((statement, parameters))
+
+async def router_calls(gene_name: str, species_name: str) -> list[tuple[str, object]]:
+    coordinate = await regulatory_sequences.get_genomic_coordinate(gene_name, species_name)
+    start, end = coordinate.start, coordinate.end
+
+    all_TFBS, all_variants = await asyncio.gather(
+        regulatory_elements.get_all_TFBS(gene_name),
+        regulatory_elements.get_all_variants(gene_name))
+
+    return [
+        ("genes.get_names", genes.get_names()),
+        ("genes.get_id", genes.get_id(gene_name)),
+        ("species.get_names", species.get_names()),
+        ("species.get_id", species.get_id(species_name)),
+        ("species.get_assemblies", species.get_assemblies(species_name)),
+        ("sequences.get_id", regulatory_sequences.get_id(species_name, gene_name)),
+        ("sequences.get_sequence_range", regulatory_sequences.get_sequence_range(gene_name, species_name, start, start + 100)),
+        ("sequences.get_total_range", regulatory_sequences.get_total_range(gene_name, species_name)),
+        ("sequences.get_allignment_numbers", regulatory_sequences.get_allignment_numbers(gene_name)),
+        ("sequences.get_sequence_coordinate", regulatory_sequences.get_sequence_coordinate(gene_name, species_name)),
+        ("sequences.get_all_sequence_coordinates", regulatory_sequences.get_all_sequence_coordinates(gene_name)),
+        ("sequences.get_all_geonomic_coordinates", regulatory_sequences.get_all_geonomic_coordinates(gene_name)),
+        ("elements.get_all_TFBS", regulatory_elements.get_all_TFBS(gene_name)),
+        ("elements.get_all_variants", regulatory_elements.get_all_variants(gene_name)),
+        ("elements.get_variants_dict", regulatory_elements.get_variants_dict(gene_name, species_name, all_variants)),
+        ("elements.get_filtered_Enh_Prom", regulatory_elements.get_filtered_Enh_Prom(gene_name, species_name, ["Enh", "Prom"], start, end)),
+        ("elements.get_filtered_TFBS", regulatory_elements.get_filtered_TFBS(gene_name, species_name, all_TFBS, start, end)),
+        ("elements.get_filtered_variants", regulatory_elements.get_filtered_variants(gene_name, species_name, all_variants, start, end)),
+        ("conservation_scores.get_histogram_data", conservation_scores.get_histogram_data(species_name, gene_name)),
+    ]
+
+async def explain(gene_name: str, species_name: str, show_plans: bool) -> None:
+    event.listen(async_engine.sync_engine, "before_cursor_execute", capture)
+
+    for name, call in await router_calls(gene_name, species_name):
+        captured.clear()
+        await call
+
+        for statement, parameters in captured:
+            async with async_engine.connect() as connection:
+                plan = (await connection.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS) {statement}", parameters)).scalars().all()
+
+            execution_time = next(line for line in plan if line.startswith("Execution Time"))
+            print(f"{name:<45} {execution_time}")
+
+            if show_plans:
+                print("\n".join(f"    {line}" for line in plan))
+
+    await async_engine.dispose()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EXPLAIN ANALYZE the queries sent by the routers")
+    parser.add_argument("--gene", default="DRD4")
+    parser.add_argument("--species", default="Homo sapiens")
+    parser.add_argument("--plans", action="store_true", help="print the full plans and not just the execution times")
+    args = parser.parse_args()
+
+    asyncio.run(explain(args.gene, args.species, args.plans))
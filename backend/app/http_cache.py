@@ -0,0 +1,188 @@
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Optional
+
+# Nothing the routers return can change until the tables are loaded again, so responses are tagged with a version of the
+# dataset and kept in memory. GET requests get an ETag and Cache-Control header and a 304 when the client already has the
+# current version of a response that succeeded, and every 200 response (GET or the POST track queries) is kept in a size
+# bounded LRU cache.
+
+# only the data routers are cached, anything else like /docs is passed straight through
+CACHED_PREFIXES = ("/genes", "/species", "/sequences", "/elements", "/conservation_scores", "/browser")
+
+MAX_CACHE_BYTES = int(os.environ.get("RESPONSE_CACHE_BYTES", 64 * 1024 * 1024))
+
+# responses bigger than this are still tagged but never stored, so one large sequence can't push everything else out
+MAX_ENTRY_BYTES = int(os.environ.get("RESPONSE_CACHE_ENTRY_BYTES", 4 * 1024 * 1024))
+
+CACHE_CONTROL = "public, no-cache"
+
+# None until a dataset has been loaded, nothing is tagged or cached before that
+dataset_version: Optional[str] = None
+
+# request key -> (status, headers, body)
+_responses: "OrderedDict[bytes, tuple[int, list[tuple[bytes, bytes]], bytes]]" = OrderedDict()
+_cached_bytes = 0
+
+# The version is made from the fingerprints app/loader.py keeps for every dataset so every worker agrees on it and it
+# changes whenever any dataset is reloaded. None if nothing has been loaded.
+def version_of(fingerprints: dict[str, str]) -> Optional[str]:
+    if not fingerprints:
+        return None
+
+    digest = hashlib.sha256()
+    for name in sorted(fingerprints):
+        digest.update(f"{name}={fingerprints[name]};".encode())
+
+    return digest.hexdigest()[:16]
+
+# Switches to a new dataset version and drops every response cached for the old one
+def set_dataset_version(version: Optional[str]) -> None:
+    global dataset_version
+
+    dataset_version = version
+    clear()
+
+def clear() -> None:
+    global _cached_bytes
+
+    _responses.clear()
+    _cached_bytes = 0
+
+# Weak because app/compression.py encodes the body after it is tagged, the identity, gzip, br and zstd bodies are the
+# same response but not the same bytes. Vary tells caches they are still stored per Accept-Encoding.
+def etag() -> bytes:
+    return f'W/"{dataset_version}"'.encode()
+
+def _validator_headers() -> list[tuple[bytes, bytes]]:
+    return [(b"etag", etag()), (b"cache-control", CACHE_CONTROL.encode()), (b"vary", b"Accept-Encoding")]
+
+def _store(key: bytes, status: int, headers: list[tuple[bytes, bytes]], body: bytes) -> None:
+    global _cached_bytes
+
+    if key in _responses:
+        return
+
+    _responses[key] = (status, headers, body)
+    _cached_bytes += len(body)
+
+    while _cached_bytes > MAX_CACHE_BYTES and _responses:
+        _, (_, _, evicted) = _responses.popitem(last=False)
+        _cached_bytes -= len(evicted)
+
+def _lookup(key: bytes) -> Optional[tuple[int, list[tuple[bytes, bytes]], bytes]]:
+    response = _responses.get(key)
+
+    if response is not None:
+        _responses.move_to_end(key)
+
+    return response
+
+def _cacheable(scope) -> bool:
+    return (scope["type"] == "http" and dataset_version is not None and scope["method"] in ("GET", "POST")
+            and scope["path"].startswith(CACHED_PREFIXES))
+
+# If-None-Match uses the weak comparison, W/"x" and "x" are the same tag
+def _matches(if_none_match: bytes) -> bool:
+    current = etag()[2:]
+    return any(tag.strip().replace(b"W/", b"", 1) in (current, b"*") for tag in if_none_match.split(b","))
+
+async def _send_not_modified(send) -> None:
+    await send({"type": "http.response.start", "status": 304, "headers": _validator_headers()})
+    await send({"type": "http.response.body", "body": b""})
+
+# Plain ASGI middleware rather than a BaseHTTPMiddleware so streaming responses are forwarded chunk by chunk
+class ResponseCacheMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not _cacheable(scope):
+            await self.app(scope, receive, send)
+            return
+
+        # The ETag only says which dataset version the client has, not that the URL was answered successfully with it, so
+        # a 304 is only sent for a successful response, either cached or returned by the handler below
+        not_modified = scope["method"] == "GET" and _matches(dict(scope["headers"]).get(b"if-none-match", b""))
+
+        # POST bodies are part of what identifies the response so the whole request body has to be read first
+        body = b""
+        more_body = scope["method"] == "POST"
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        key = hashlib.sha256(b"\0".join([scope["method"].encode(), scope["path"].encode(), scope["query_string"], body])).digest()
+
+        cached = _lookup(key)
+
+        if cached is not None:
+            status, headers, cached_body = cached
+
+            if not_modified and 200 <= status < 300:
+                await _send_not_modified(send)
+                return
+
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+            await send({"type": "http.response.body", "body": cached_body})
+            return
+
+        replayed = False
+
+        async def replay():
+            nonlocal replayed
+
+            if scope["method"] != "POST":
+                return await receive()
+
+            if replayed:
+                return {"type": "http.disconnect"}
+
+            replayed = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        version = dataset_version
+        status = 0
+        headers: list[tuple[bytes, bytes]] = []
+        chunks: Optional[list[bytes]] = []
+        size = 0
+
+        async def tag_and_record(message):
+            nonlocal status, headers, chunks, size, not_modified
+
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+                if status == 200:
+                    headers = [(name, value) for name, value in message.get("headers", []) if name.lower() not in (b"etag", b"cache-control", b"vary")]
+                    if scope["method"] == "GET":
+                        headers += _validator_headers()
+                    message = {**message, "headers": headers}
+                else:
+                    chunks = None
+                    not_modified = False
+
+                # the body is still read and cached, the client just doesn't get it
+                if not_modified:
+                    await _send_not_modified(send)
+                    return
+
+            elif message["type"] == "http.response.body" and chunks is not None:
+                chunks.append(message.get("body", b""))
+                size += len(chunks[-1])
+
+                # streamed responses are never kept, holding on to them would defeat the point of streaming
+                if size > MAX_ENTRY_BYTES or (len(chunks) == 1 and message.get("more_body", False)):
+                    chunks = None
+                elif not message.get("more_body", False) and version == dataset_version:
+                    _store(key, status, headers, b"".join(chunks))
+
+            if not_modified:
+                return
+
+            await send(message)
+
+        await self.app(scope, replay, tag_and_record)
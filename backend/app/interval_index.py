@@ -0,0 +1,86 @@
+from bisect import bisect_left, bisect_right
+from typing import Optional
+from sqlalchemy import select
+from app.models import EnhancersPromoters, Genes, RegulatorySequences, Species, TranscriptionFactorBindingSites, Variants
+from app.utils import async_session
+
+# rows are (category, start, end, chromosome), the same columns get_elements used to select
+Row = tuple[str, int, int, int]
+
+INDEXED_MODELS = [EnhancersPromoters, TranscriptionFactorBindingSites, Variants]
+
+class IntervalIndex:
+
+    def __init__(self, rows: list[Row]):
+        # stable sort so rows with the same start stay in load order
+        self.rows = sorted(rows, key=lambda row: row[1])
+        self.starts = [row[1] for row in self.rows]
+
+        # max_ends[i] is the largest end of rows[0..i], it never decreases so it can be binary searched too
+        self.max_ends: list[int] = []
+        max_end = None
+        for row in self.rows:
+            max_end = row[2] if max_end is None else max(max_end, row[2])
+            self.max_ends.append(max_end)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    # Same overlap rule as the old sql query, rows are returned ordered by start
+    def overlapping(self, start: int, end: int, categories: Optional[set[str]] = None) -> list[Row]:
+
+        # nothing before the first row whose running max end reaches the window can overlap it
+        # and nothing starting after the window can either
+        first = bisect_left(self.max_ends, min(start, end))
+        last = bisect_right(self.starts, max(start, end))
+
+        result: list[Row] = []
+
+        for i in range(first, last):
+            row = self.rows[i]
+
+            if categories is not None and row[0] not in categories:
+                continue
+
+            if (start <= row[1] < end) or (start < row[2] <= end) or (row[1] <= start and row[2] >= end):
+                result.append(row)
+
+        return result
+
+# (table name, gene name, species name) -> index, None until the first build has finished
+_indexes: Optional[dict[tuple[str, str, str], IntervalIndex]] = None
+
+# Reads every element table once and rebuilds all of the indexes, has to be called again whenever the tables are reloaded
+async def build_indexes() -> None:
+    global _indexes
+
+    grouped: dict[tuple[str, str, str], list[Row]] = {}
+
+    async with async_session() as session:
+        for model in INDEXED_MODELS:
+            stmt = (select(model.category, model.start, model.end, model.chromosome, Genes.name, Species.name)
+                    .select_from(model)
+                    .join(RegulatorySequences)
+                    .join(Genes)
+                    .join(Species)
+                    .order_by(model.id))
+
+            result = (await session.execute(stmt)).tuples().all()
+
+            for category, start, end, chromosome, gene_name, species_name in result:
+                grouped.setdefault((model.__tablename__, gene_name, species_name), []).append((category, start, end, chromosome))
+
+    # swapped in all at once so requests never see a half built set of indexes
+    _indexes = {key: IntervalIndex(rows) for key, rows in grouped.items()}
+
+    print(f"built {len(_indexes)} interval indexes over {sum(len(index) for index in _indexes.values())} elements")
+
+# Returns the index for this table, gene and species or None if the indexes haven't been built yet
+def get_index(model: type, gene_name: str, species_name: str) -> Optional[IntervalIndex]:
+    if _indexes is None:
+        return None
+
+    return _indexes.get((model.__tablename__, gene_name, species_name), IntervalIndex([]))
+
+def all_indexes() -> dict[tuple[str, str, str], IntervalIndex]:
+    return _indexes if _indexes is not None else {}
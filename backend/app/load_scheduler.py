@@ -0,0 +1,213 @@
+import asyncio
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Optional
+
+# Runs the loader as a graph of stages. Every stage declares the stages it depends on and starts as soon as all of them
+# are done, so independent stages run at the same time and the whole load takes as long as its slowest chain of stages
+# (the critical path) instead of the sum of all of them. CPU heavy parsing is handed to a pool of worker processes
+# with in_process so it doesn't hold up the event loop that is waiting on the database. Stages waiting for one of the
+# limited slots get them in the order they were scheduled, except for ones loading a dataset that has been prioritized.
+
+# worker processes used for parsing, by default one per CPU
+LOADER_PROCESSES = int(os.environ.get("LOADER_PROCESSES", os.cpu_count() or 1))
+
+# stages running at the same time, each one holds a database connection or two so this has to stay below the size of the
+# connection pool. Waiting stages hold nothing, so memory and connections stay the same however many stages there are.
+LOADER_CONCURRENCY = int(os.environ.get("LOADER_CONCURRENCY", 4))
+
+# jobs every in_processes call keeps queued for the worker processes, results are only held until they are used
+JOBS_AHEAD = 2
+
+TIMELINE_WIDTH = 40
+
+@dataclass
+class Stage:
+    name: str
+    # called with the results of the stages in depends_on by name, whatever it returns is passed on to its dependents
+    run: Callable[[dict[str, Any]], Awaitable[Any]]
+    depends_on: list[str] = field(default_factory=list)
+    # datasets the stage loads, stages loading a prioritized one run first
+    datasets: list[str] = field(default_factory=list)
+
+@dataclass
+class StageTiming:
+    name: str
+    depends_on: list[str]
+    start: float
+    end: float
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+# Runs function(*args) in one of the worker processes, both have to be picklable so the function must be defined at the
+# top level of a module
+async def in_process(function: Callable, *args) -> Any:
+    global _pool
+
+    if _pool is None:
+        # spawned rather than forked so the workers don't inherit the event loop or open database connections
+        _pool = ProcessPoolExecutor(max_workers=max(LOADER_PROCESSES, 1), mp_context=multiprocessing.get_context("spawn"))
+
+    return await asyncio.get_running_loop().run_in_executor(_pool, function, *args)
+
+# Runs function on every argument tuple in the worker processes and yields the results in order. Arguments are taken
+# from the iterable only as workers free up, so a long stream of them is never read or held in memory all at once.
+async def in_processes(function: Callable, arguments: Iterable[tuple]) -> AsyncIterator[Any]:
+    pending: deque = deque()
+
+    try:
+        for args in arguments:
+            pending.append(asyncio.ensure_future(in_process(function, *args)))
+
+            if len(pending) >= max(LOADER_PROCESSES, 1) * JOBS_AHEAD:
+                yield await pending.popleft()
+
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+
+def shutdown_processes() -> None:
+    global _pool
+
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+# Orders the stages so every stage comes after its dependencies, raises if one depends on a stage that doesn't exist or
+# if they depend on each other in a cycle
+def dependency_order(stages: list[Stage]) -> list[Stage]:
+    by_name = {stage.name: stage for stage in stages}
+    ordered: list[Stage] = []
+    done: set[str] = set()
+    visiting: set[str] = set()
+
+    def visit(stage: Stage) -> None:
+        if stage.name in done:
+            return
+
+        if stage.name in visiting:
+            raise ValueError(f"loader stages depend on each other in a cycle through {stage.name}")
+
+        visiting.add(stage.name)
+
+        for dependency in stage.depends_on:
+            if dependency not in by_name:
+                raise ValueError(f"loader stage {stage.name} depends on {dependency} which doesn't exist")
+            visit(by_name[dependency])
+
+        visiting.remove(stage.name)
+        done.add(stage.name)
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+
+    return ordered
+
+# Hands out a limited number of slots to stages, a freed slot goes to the first waiting stage that loads a prioritized
+# dataset or to the one that has waited longest if none of them do
+class StageSlots:
+
+    def __init__(self, limit: int, prioritized: set[str]):
+        self.free = limit
+        self.prioritized = prioritized
+        self.waiting: list[tuple[Stage, asyncio.Future]] = []
+
+    async def acquire(self, stage: Stage) -> None:
+        if self.free > 0:
+            self.free -= 1
+            return
+
+        slot = asyncio.get_running_loop().create_future()
+        self.waiting.append((stage, slot))
+
+        try:
+            await slot
+        except asyncio.CancelledError:
+            if not slot.done():
+                self.waiting.remove((stage, slot))
+            elif not slot.cancelled():
+                # cancelled right after it was given the slot, which has to be passed on
+                self.release()
+            raise
+
+    def release(self) -> None:
+        if not self.waiting:
+            self.free += 1
+            return
+
+        index = next((i for i, (stage, _) in enumerate(self.waiting) if self.prioritized.intersection(stage.datasets)), 0)
+        _, slot = self.waiting.pop(index)
+        slot.set_result(None)
+
+# Runs every stage as soon as its dependencies are done, with at most limit of them running at once, and returns when
+# they have all finished. If one fails the stages still running are cancelled and the error is raised. Datasets can be
+# added to prioritized while the stages run.
+async def run_stages(stages: list[Stage], limit: int = LOADER_CONCURRENCY, prioritized: Optional[set[str]] = None) -> list[StageTiming]:
+    tasks: dict[str, asyncio.Task] = {}
+    timings: list[StageTiming] = []
+    slots = StageSlots(max(limit, 1), prioritized if prioritized is not None else set())
+    begin = perf_counter()
+
+    async def run(stage: Stage) -> Any:
+        results = {dependency: await tasks[dependency] for dependency in stage.depends_on}
+
+        await slots.acquire(stage)
+        try:
+            start = perf_counter() - begin
+            result = await stage.run(results)
+            timings.append(StageTiming(stage.name, stage.depends_on, start, perf_counter() - begin))
+        finally:
+            slots.release()
+
+        return result
+
+    for stage in dependency_order(stages):
+        tasks[stage.name] = asyncio.create_task(run(stage))
+
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+
+    return timings
+
+# Follows the dependency every stage waited on longest back from the stage that finished last
+def critical_path(timings: list[StageTiming]) -> list[StageTiming]:
+    if not timings:
+        return []
+
+    by_name = {timing.name: timing for timing in timings}
+    path = [max(timings, key=lambda timing: timing.end)]
+
+    while path[-1].depends_on:
+        path.append(max((by_name[name] for name in path[-1].depends_on), key=lambda timing: timing.end))
+
+    return path[::-1]
+
+def print_timeline(timings: list[StageTiming]) -> None:
+    if not timings:
+        return
+
+    total = max(timing.end for timing in timings)
+    path = critical_path(timings)
+    scale = TIMELINE_WIDTH / total if total > 0 else 0
+
+    print(f"load timeline, {total:.2f}s in total and {sum(timing.end - timing.start for timing in timings):.2f}s of stages:")
+
+    for timing in sorted(timings, key=lambda timing: (timing.start, timing.end)):
+        offset = round(timing.start * scale)
+        bar = " " * offset + "#" * max(round(timing.end * scale) - offset, 1)
+        marker = "*" if timing in path else " "
+        print(f" {marker}{timing.name:<45} {timing.start:>7.2f}s {timing.end:>7.2f}s  |{bar:<{TIMELINE_WIDTH}}|")
+
+    print(f"  critical path (*): {' -> '.join(timing.name for timing in path)}")
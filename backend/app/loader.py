@@ -0,0 +1,416 @@
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.postgresql import insert
+from csv import DictReader
+from functools import partial
+from itertools import islice
+from typing import Any, Awaitable, Callable, Iterator
+import asyncio
+import os
+import sys
+from app.models import *
+from app.utils import async_engine, async_session
+from app import bulk_load, load_scheduler, migrations, sequence_store
+from app.bulk_load import timed
+from app.load_scheduler import Stage, in_processes
+from app.manifest import ElementFiles, Manifest, read_manifest
+
+# Fills the database and the sequence store from a data directory. This runs once before the server is started, the
+# server itself only reads what was loaded here (see lifespan in app/main.py) so it can run as any number of workers.
+#
+#   python -m app.loader [data directory or manifest file, app/data by default]
+#
+# Which files hold what is described by app/manifest.py. Every gene with a conservation file and every gene/species pair
+# in the regulatory sequences file is loaded, nothing here depends on how many there are.
+#
+# Every dataset is fingerprinted and the fingerprint is kept in LoadedDatasets, so running it again only reloads the
+# datasets whose files changed. Genes, species and sequences are upserted so their ids stay the same, every other
+# dataset is replaced as a whole in one transaction.
+#
+# Datasets are loaded as stages of app/load_scheduler.py, every one as soon as the datasets it depends on are done.
+# Files are streamed in batches that are parsed in the worker processes while the previous batch is written, so memory
+# stays bounded by the batch sizes below however big the files get.
+#
+# The server can run at the same time (see app/readiness.py). Every dataset that is going to be loaded is kept in
+# LoadingDatasets with its state until it is done, and a dataset the server asks for on bulk_load.PRIORITY_CHANNEL is
+# loaded as soon as a stage slot frees up, ahead of the ones that were scheduled before it.
+
+DATA_DIR = "app/data"
+
+# rows of an element file parsed in one go
+ELEMENT_BATCH_ROWS = 20000
+
+# conservation files loaded together in one stage, their scores and nucleotides are each written with a single COPY
+CONSERVATION_BATCH_GENES = 50
+
+# sequences already in the table are updated this many at a time
+SEQUENCE_UPDATE_BATCH = 16
+
+# genes and species are inserted this many rows per statement
+INSERT_BATCH = 1000
+
+def batches(rows: Iterator, size: int) -> Iterator[list]:
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+async def load_Genes(manifest: Manifest) -> None:
+    with timed("Genes") as timing:
+        async with async_session() as session:
+            print("loading genes table")
+
+            with open(manifest.genes, "r") as file:
+
+                reader = DictReader(file)
+
+                for rows in batches((dict(row) for row in reader), INSERT_BATCH):
+                    stmt = insert(Genes).values(rows).on_conflict_do_nothing(index_elements=[Genes.name])
+
+                    await session.execute(stmt)
+                    timing.rows += len(rows)
+
+                await session.commit()
+
+async def load_Species(manifest: Manifest) -> None:
+    with timed("Species") as timing:
+        async with async_session() as session:
+            print("loading species table")
+
+            with open(manifest.species, "r") as file:
+
+                reader = DictReader(file)
+
+                for rows in batches((dict(row) for row in reader), INSERT_BATCH):
+                    stmt = insert(Species).values(rows)
+                    stmt = stmt.on_conflict_do_update(index_elements=[Species.name], set_={"assembly": stmt.excluded.assembly})
+
+                    await session.execute(stmt)
+                    timing.rows += len(rows)
+
+                await session.commit()
+
+def read_sequence(path: str) -> str:
+    with open(path, "r") as f:
+        return "".join(f.read().splitlines())
+
+# The regulatory sequences file and the sequence file of every row in it
+def regulatory_sequence_files(manifest: Manifest) -> list[str]:
+    with open(manifest.regulatory_sequences, "r") as file:
+        return [file.name] + [manifest.sequence_path(row["fk_species"], row["fk_gene"]) for row in DictReader(file)]
+
+# Reads one sequence and writes its packed copy to the sequence store, the copy outlives the data directory and is what
+# range reads are served from. Runs in a worker process since packing is the slowest part of loading.
+def prepare_sequence(row: dict[str, str], path: str) -> tuple[dict[str, str], str]:
+    sequence = read_sequence(path)
+    sequence_store.write_sequence(row["fk_gene"], row["fk_species"], sequence)
+
+    return row, sequence
+
+# Writes a sequence to the sequence store if it's missing there, which happens when the database was kept but the store
+# wasn't. Only checks the file is there since opening it would keep it open in the worker.
+def restore_sequence(row: dict[str, str], path: str) -> None:
+    if not os.path.exists(sequence_store.sequence_path(row["fk_gene"], row["fk_species"])):
+        sequence_store.write_sequence(row["fk_gene"], row["fk_species"], read_sequence(path))
+
+async def restore_sequence_store(manifest: Manifest) -> None:
+    with open(manifest.regulatory_sequences, "r") as file:
+        async for _ in in_processes(restore_sequence, ((row, manifest.sequence_path(row["fk_species"], row["fk_gene"])) for row in DictReader(file))):
+            pass
+
+REGULATORY_SEQUENCE_COLUMNS = ["gene_id", "species_id", "gene_start", "gene_end", "sequence", "total_start", "total_end", "allignment_num"]
+
+async def update_sequences(updates: list[dict]) -> None:
+    async with async_session() as session:
+        await session.execute(update(RegulatorySequences), updates)
+        await session.commit()
+
+async def load_RegulatorySequences(manifest: Manifest) -> None:
+    with timed("RegulatorySequences") as timing:
+        print("loading regulatory sequences table")
+
+        # Since this table depends on Genes and Species we need to get the correct id's for the given values
+        gene_id_map, species_id_map, reg_seq_ids = await asyncio.gather(bulk_load.gene_ids(), bulk_load.species_ids(), bulk_load.regulatory_sequence_ids())
+
+        with open(manifest.regulatory_sequences, "r") as file:
+
+            reader = DictReader(file)
+
+            def sequence_files():
+                for row in reader:
+
+                    if row["fk_gene"] not in gene_id_map:
+                        raise ValueError("Unable to get gene")
+
+                    if row["fk_species"] not in species_id_map:
+                        raise ValueError("Unable to get species")
+
+                    yield row, manifest.sequence_path(row["fk_species"], row["fk_gene"])
+
+            async def rows():
+                # sequences that are already in the table are updated in place so the elements pointing at them stay valid
+                updates: list[dict] = []
+
+                async for row, sequence in in_processes(prepare_sequence, sequence_files()):
+                    values = (gene_id_map[row["fk_gene"]],
+                              species_id_map[row["fk_species"]],
+                              int(row["gene_start"]),
+                              int(row["gene_end"]),
+                              sequence,
+                              int(row["total_start"]),
+                              int(row["total_end"]),
+                              int(row["allignment_num"]))
+
+                    reg_seq_id = reg_seq_ids.get((row["fk_gene"], row["fk_species"]))
+
+                    if reg_seq_id is None:
+                        yield values
+                        continue
+
+                    updates.append(dict(zip(["id"] + REGULATORY_SEQUENCE_COLUMNS, (reg_seq_id,) + values)))
+                    timing.rows += 1
+
+                    if len(updates) >= SEQUENCE_UPDATE_BATCH:
+                        await update_sequences(updates)
+                        updates = []
+
+                if updates:
+                    await update_sequences(updates)
+
+            timing.rows += await bulk_load.copy_rows(RegulatorySequences, REGULATORY_SEQUENCE_COLUMNS, rows())
+
+# Enhancers/promoters, TFBS and variants all have the same layout so they share one parser and loader. The parser runs
+# in a worker process on a batch of lines and returns (gene, species, chromosome, category, start, end) for every row.
+# Files are split on lines so fields can't contain line breaks, which none of these files have.
+def parse_elements(lines: list[str], columns: dict[str, str], delimiter: str) -> list[tuple[str, str, int, str, int, int]]:
+    return [(row[columns["gene"]],
+             row[columns["species"]],
+             int(row[columns["chromosome"]]),
+             row[columns["category"]],
+             int(row[columns["start"]]),
+             int(row[columns["end"]])) for row in DictReader(lines, delimiter=delimiter)]
+
+async def load_elements(model: type, elements: ElementFiles) -> None:
+    print(f"loading {elements.description}")
+
+    with timed(model.__tablename__) as timing:
+        # resolve every gene/species pair once up front instead of querying for every row
+        reg_seq_ids = await bulk_load.regulatory_sequence_ids()
+
+        # every batch of lines with the header of its file in front
+        def line_batches():
+            for path in elements.paths:
+                with open(path, "r") as file:
+                    header = file.readline()
+
+                    for lines in batches(file, ELEMENT_BATCH_ROWS):
+                        yield [header] + lines, elements.columns, elements.delimiter
+
+        async def rows():
+            async for parsed in in_processes(parse_elements, line_batches()):
+                for gene_name, species_name, chromosome, category, start, end in parsed:
+
+                    reg_seq_id = reg_seq_ids.get((gene_name, species_name))
+
+                    if reg_seq_id is None:
+                        raise ValueError(f"Unable to find regulatory sequence for {elements.description} for {gene_name} and {species_name}")
+
+                    yield (chromosome, category, start, end, reg_seq_id)
+
+        timing.rows = await bulk_load.copy_rows(model, ["chromosome", "category", "start", "end", "regulatory_sequence_id"], rows(), delete=[delete(model)])
+
+ELEMENT_MODELS = {model.__tablename__: model for model in [EnhancersPromoters, TranscriptionFactorBindingSites, Variants]}
+
+# headers look like bp_12, the number is kept in its own column so positions can be ordered numerically
+def position_number(header: str) -> int:
+    return int(header.rsplit("_", 1)[-1])
+
+# Returns the gene, the species columns the file has and (header, phylop score, phastcon score, nucleotide of every
+# species column) for every row. Runs in a worker process.
+def parse_conservation(gene_name: str, path: str, species_columns: list[str]) -> tuple[str, list[str], list[tuple[str, float, float, tuple[str, ...]]]]:
+    with open(path, "r") as file:
+        reader = DictReader(file)
+        fieldnames = reader.fieldnames or []
+
+        unknown = [column for column in fieldnames if column not in ("header", "phylop_score", "phastcon_score") and column not in species_columns]
+        if unknown:
+            raise ValueError(f"Conservation file for {gene_name} has columns {unknown} that aren't mapped to a species")
+
+        columns = [column for column in species_columns if column in fieldnames]
+
+        return gene_name, columns, [(row["header"], float(row["phylop_score"]), float(row["phastcon_score"]), tuple(row[column] for column in columns))
+                                    for row in reader]
+
+# Loads the conservation analysis of a batch of genes, replacing whatever was loaded for them before
+async def load_conservation(manifest: Manifest, gene_names: list[str]) -> None:
+    print(f"loading conservation analysis and sequences tables for {', '.join(gene_names)}")
+
+    gene_id_map, species_id_map = await asyncio.gather(bulk_load.gene_ids(), bulk_load.species_ids())
+
+    missing = [gene_name for gene_name in gene_names if gene_name not in gene_id_map]
+    if missing:
+        raise ValueError(f"Unable to get genes {missing} for their conservation analysis")
+
+    column_species = {column: species_id_map[species_name] for column, species_name in manifest.conservation_columns.items() if species_name in species_id_map}
+    gene_ids = [gene_id_map[gene_name] for gene_name in gene_names]
+
+    parsed = [(gene_id_map[gene_name], columns, rows) async for gene_name, columns, rows
+              in in_processes(parse_conservation, ((gene_name, manifest.conservation[gene_name], list(column_species)) for gene_name in gene_names))]
+
+    with timed(f"ConservationScores ({len(gene_names)} genes)") as scores_timing:
+        # the genes' previous scores and the nucleotides pointing at them are replaced
+        gene_scores = select(ConservationScores.id).where(ConservationScores.gene_id.in_(gene_ids))
+
+        scores_timing.rows = await bulk_load.copy_rows(
+            ConservationScores,
+            ["gene_id", "phylop_score", "phastcon_score", "position", "position_number"],
+            ((gene_id, phylop_score, phastcon_score, header, position_number(header))
+             for gene_id, _, rows in parsed for header, phylop_score, phastcon_score, _ in rows),
+            delete=[delete(ConservationNucleotides).where(ConservationNucleotides.conservation_id.in_(gene_scores)),
+                    delete(ConservationScores).where(ConservationScores.gene_id.in_(gene_ids))])
+
+    with timed(f"ConservationNucleotides ({len(gene_names)} genes)") as nucleotides_timing:
+        # COPY doesn't hand back the generated ids, positions are unique per gene so we use them to look the ids up again
+        async with async_session() as session:
+            stmt = select(ConservationScores.gene_id, ConservationScores.position, ConservationScores.id).where(ConservationScores.gene_id.in_(gene_ids))
+            position_ids = {(gene_id, position): id for gene_id, position, id in (await session.execute(stmt)).tuples().all()}
+
+        # add every species' nucleotide to the conservaiton sequences table
+        nucleotides_timing.rows = await bulk_load.copy_rows(
+            ConservationNucleotides,
+            ["species_id", "conservation_id", "nucleotide"],
+            ((column_species[column], position_ids[(gene_id, header)], nucleotide)
+             for gene_id, columns, rows in parsed for header, _, _, nucleotides in rows for column, nucleotide in zip(columns, nucleotides)))
+
+# Runs the loader of some datasets and records them as loaded, their state in LoadingDatasets is kept up to date so
+# the server can tell what is still loading and what failed
+async def load_datasets(fingerprints: dict[str, str], loader: Callable[[], Awaitable[None]]) -> None:
+    await bulk_load.mark_datasets(list(fingerprints), "loading")
+
+    try:
+        await loader()
+    except Exception as error:
+        await bulk_load.mark_datasets(list(fingerprints), "failed", f"{type(error).__name__}: {error}")
+        raise
+
+    await bulk_load.record_datasets(fingerprints)
+
+# Adds the stage that loads a dataset unless its files have the same fingerprint as when it was last loaded, returns
+# whether it was added. Dependencies that aren't being loaded this time are already in the database and are left out.
+def add_dataset(stages: list[Stage], loaded: dict[str, str], name: str, paths: list[str], depends_on: list[str],
+                loader: Callable[[], Awaitable[None]]) -> bool:
+
+    fingerprint = bulk_load.fingerprint(paths)
+
+    if loaded.get(name) == fingerprint:
+        print(f"{name} hasn't changed, skipping")
+        return False
+
+    scheduled = {stage.name for stage in stages}
+
+    async def run(results: dict[str, Any]) -> None:
+        await load_datasets({name: fingerprint}, loader)
+
+    stages.append(Stage(name, run, [dependency for dependency in depends_on if dependency in scheduled], [name]))
+
+    return True
+
+# Every gene's conservation analysis is its own dataset, the ones that changed are loaded in batches of genes
+def add_conservation(stages: list[Stage], loaded: dict[str, str], manifest: Manifest) -> None:
+    fingerprints = {}
+
+    for gene_name, path in manifest.conservation.items():
+        fingerprint = bulk_load.fingerprint([path])
+
+        if loaded.get(f"ConservationAnalysis {gene_name}") != fingerprint:
+            fingerprints[gene_name] = fingerprint
+
+    print(f"conservation analysis changed for {len(fingerprints)} of {len(manifest.conservation)} genes")
+
+    scheduled = {stage.name for stage in stages}
+    gene_names = list(fingerprints)
+
+    for start in range(0, len(gene_names), CONSERVATION_BATCH_GENES):
+        batch = gene_names[start:start + CONSERVATION_BATCH_GENES]
+
+        datasets = {f"ConservationAnalysis {gene_name}": fingerprints[gene_name] for gene_name in batch}
+
+        async def run(results: dict[str, Any], batch: list[str] = batch, datasets: dict[str, str] = datasets) -> None:
+            await load_datasets(datasets, partial(load_conservation, manifest, batch))
+
+        name = f"ConservationAnalysis {batch[0]}" + (f" .. {batch[-1]}" if len(batch) > 1 else "")
+        stages.append(Stage(name, run, [dependency for dependency in ["Genes", "Species"] if dependency in scheduled], list(datasets)))
+
+async def load(source: str = DATA_DIR) -> None:
+
+    if not os.path.exists(source):
+        print(f"{source} doesn't exist, nothing to load")
+        return
+
+    manifest = read_manifest(source)
+
+    await migrations.apply_migrations()
+
+    loaded = await bulk_load.loaded_fingerprints()
+
+    print("Started loading tables")
+
+    stages: list[Stage] = []
+
+    # Genes and species don't depend on anything but everything depends on them
+    add_dataset(stages, loaded, "Genes", [manifest.genes], [], partial(load_Genes, manifest))
+    add_dataset(stages, loaded, "Species", [manifest.species], [], partial(load_Species, manifest))
+
+    if not add_dataset(stages, loaded, "RegulatorySequences", regulatory_sequence_files(manifest), ["Genes", "Species"],
+                       partial(load_RegulatorySequences, manifest)):
+        stages.append(Stage("restore sequence store", lambda results: restore_sequence_store(manifest)))
+
+    add_conservation(stages, loaded, manifest)
+
+    # Regulatory elements point at regulatory sequences so they are written after them
+    for elements in manifest.elements:
+        if elements.table not in ELEMENT_MODELS:
+            raise ValueError(f"{elements.table} in the manifest is not an element table, it has to be one of {list(ELEMENT_MODELS)}")
+
+        if not elements.paths:
+            print(f"no files for {elements.table}, skipping")
+            continue
+
+        # all of them are loaded into the table, which is a mistake if one is just an older export of the other
+        if len(elements.paths) > 1:
+            print(f"{elements.table} is loaded from {len(elements.paths)} files: {', '.join(os.path.basename(path) for path in elements.paths)}")
+
+        add_dataset(stages, loaded, elements.table, elements.paths, ["RegulatorySequences"], partial(load_elements, ELEMENT_MODELS[elements.table], elements))
+
+    datasets = [dataset for stage in stages for dataset in stage.datasets]
+    await bulk_load.start_loading(datasets)
+
+    prioritized: set[str] = set()
+    listener = asyncio.create_task(bulk_load.listen_for_priorities(prioritized))
+
+    try:
+        timeline = await load_scheduler.run_stages(stages, prioritized=prioritized)
+    except BaseException:
+        # datasets the failed load never got to are left as failed too so the server doesn't wait for them
+        unfinished = [dataset for dataset, (state, _, _) in (await bulk_load.loading_states()).items() if state != "failed"]
+        if unfinished:
+            await bulk_load.mark_datasets(unfinished, "failed", "the load stopped before it got to this dataset")
+        raise
+    finally:
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+        load_scheduler.shutdown_processes()
+
+    print("Finished loading tables")
+    bulk_load.print_timing_report()
+    load_scheduler.print_timeline(timeline)
+
+    if bulk_load.load_timings:
+        await migrations.analyze()
+
+async def main() -> None:
+    await load(sys.argv[1] if len(sys.argv) > 1 else DATA_DIR)
+    await async_engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,253 +1,93 @@
 from fastapi import FastAPI
-from sqlalchemy import insert, select
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
-from csv import DictReader
+from typing import Optional
 import asyncio
-import shutil
-from app.models import *
-from app.routers import genes, species, regulatory_sequences, regulatory_elements, conservation_scores
-from app.utils import async_session
+from app.routers import genes, species, regulatory_sequences, regulatory_elements, conservation_scores, browser, health, metrics
+from app.utils import RequestSessionMiddleware
+from app import compression, http_cache, interval_index, metadata, readiness, request_metrics, sequence_store, tiles
 
+# genes whose conservation matrices are rebuilt in one go while serving, the event loop is free to answer requests
+# between them instead of being held up by a whole batch
+MATRIX_REBUILD_GENES = 10
 
-async def load_Genes() -> None:
-    async with async_session() as session:
-        print("loading genes table")
+async def refresh_matrices(gene_names: Optional[list[str]]) -> None:
+    if not readiness.SERVE_WHILE_LOADING:
+        await conservation_scores.refresh_matrices(gene_names)
+        return
 
-        with open("app/data/Genes.csv", "r") as file:
+    if gene_names is None:
+        gene_names = list((await metadata.get_metadata()).genes)
 
-            reader = DictReader(file)
-            rows = [dict(row) for row in reader]
-            
-            stmt = insert(Genes).values(rows)
+    for start in range(0, len(gene_names), MATRIX_REBUILD_GENES):
+        await conservation_scores.refresh_matrices(gene_names[start:start + MATRIX_REBUILD_GENES])
 
-            await session.execute(stmt)
-            await session.commit()
+# Rebuilds the in memory indexes and caches that are made from the changed datasets, or all of them if changed is None
+async def rebuild(changed: Optional[set[str]]) -> None:
 
-async def load_Species() -> None:
-    async with async_session() as session:
-        print("loading species table")
+    def touched(*names: str) -> bool:
+        return changed is None or any(name in changed for name in names)
 
-        with open("app/data/Species.csv", "r") as file:
+    builds = []
 
-            
-            reader = DictReader(file)
-            rows = [dict(row) for row in reader]
-            
-            stmt = insert(Species).values(rows)
+    if touched("RegulatorySequences"):
+        # the loader replaced the sequence store files, this worker still has the old ones mapped
+        sequence_store.reopen_files()
 
-            await session.execute(stmt)
-            await session.commit()
+    if touched("Genes", "Species", "RegulatorySequences"):
+        # everything else looks names up in the metadata so it is refreshed first
+        await metadata.refresh_metadata()
+        builds.append(regulatory_sequences.refresh_offsets())
 
-async def load_RegulatorySequences() -> None:
-    async with async_session() as session:
-        print("loading regulatory sequences table")
+    if touched("RegulatorySequences", *readiness.ELEMENT_DATASETS):
+        builds.append(interval_index.build_indexes())
 
-        with open("app/data/RegulatorySequences.csv", "r") as file:
-            
-            reader = DictReader(file)
-            
-            # Since this table depends on Genes and Species we need to get the correct id's for the given values
+    if touched("Genes", "Species"):
+        builds.append(refresh_matrices(None))
+    else:
+        # every gene's conservation analysis is its own dataset so only the genes that were loaded are rebuilt
+        gene_names = [name[len(readiness.CONSERVATION_PREFIX):] for name in changed if name.startswith(readiness.CONSERVATION_PREFIX)]
+        if gene_names:
+            builds.append(refresh_matrices(gene_names))
 
-            for row in reader:
+    await asyncio.gather(*builds)
 
-                stmt = select(Genes).where(Genes.name == row["fk_gene"])
-                local_gene = (await session.execute(stmt)).scalar()
-
-                if local_gene is None:
-                    raise ValueError("Unable to get gene")
-                
-                stmt = select(Species).where(Species.name == row["fk_species"])
-                local_species = (await session.execute(stmt)).scalar()
-
-                if local_species is None:
-                    raise ValueError("Unable to get species")
-                
-                with open(f"app/data/{local_species.name}-{local_gene.name}.txt", "r") as f:
-                    sequence = "".join(f.read().splitlines())
-
-                    regulatory_sequences_object = RegulatorySequences(
-                        gene_id = local_gene.id,
-                        species_id = local_species.id,
-                        gene_start = int(row["gene_start"]),
-                        gene_end = int(row["gene_end"]),
-                        sequence = sequence,
-                        total_start = int(row["total_start"]),
-                        total_end = int(row["total_end"]),
-                        allignment_num = int(row["allignment_num"]))
-                    session.add(regulatory_sequences_object)
-
-            await session.commit()
-
-async def load_Enh_Prom() -> None:
-    async with async_session() as session:
-
-        print("loading enahncers and promoters")
-
-        with open("app/data/Complete_2Mil_Enh_Prom.csv", "r") as file:
-
-                
-            reader = DictReader(file)        
-
-            for row in reader:
-                gene_name = row["Gene"]
-                species_name = row["Species"]
-                stmt = select(RegulatorySequences).join(Genes).join(Species).where(Genes.name == gene_name).where(Species.name == species_name)
-
-                reg_seq = (await session.execute(stmt)).scalar()
-
-                if reg_seq is None:
-                    raise ValueError(f"Unable to find regulatory sequence for Enh and Proms for {gene_name} and {species_name}")
-
-                enh_prom_object = EnhancersPromoters(
-                    chromosome = int(row["Chromosome"]),
-                    category = row["Enh_Prom"],
-                    start = int(row["Type_Start"]),
-                    end = int(row["Type_End"]),
-                    regulatory_sequence_id = reg_seq.id)
-                
-                session.add(enh_prom_object)
-
-            await session.commit()
-
-async def load_TFBS() -> None:
-    async with async_session() as session:
-
-        print("loading Transcription Factor Binding Sites")
-
-        with open("app/data/Complete_TFBS.csv", "r") as file:
-   
-            reader = DictReader(file)        
-
-            for row in reader:
-                gene_name = row["Gene"]
-                species_name = row["Species"]
-                stmt = select(RegulatorySequences).join(Genes).join(Species).where(Genes.name == gene_name).where(Species.name == species_name)
-
-                reg_seq = (await session.execute(stmt)).scalar()
-
-                if reg_seq is None:
-                    raise ValueError(f"Unable to find regulatory sequence for TFBS for {gene_name} and {species_name}")
-
-                enh_prom_object = TranscriptionFactorBindingSites(
-                    chromosome = int(row["Chromosome"]),
-                    category = row["Type"],
-                    start = int(row["Type_Start"]),
-                    end = int(row["Type_End"]),
-                    regulatory_sequence_id = reg_seq.id)
-                
-                session.add(enh_prom_object)
-            
-            await session.commit()
-
-async def load_variants() -> None:
-    async with async_session() as session:
-
-        print("loading variants")
-
-        with open("app/data/variants_november_6_2025.tsv", "r") as file:
-
-            reader = DictReader(file, delimiter="\t")
-
-            for row in reader:
-                gene_name = row["gene"]
-                species_name = row["species"]
-                stmt = select(RegulatorySequences).join(Genes).join(Species).where(Genes.name == gene_name).where(Species.name == species_name)
-
-                reg_seq = (await session.execute(stmt)).scalar()
-
-                if reg_seq is None:
-                    raise ValueError(f"Unable to find regulatory sequence for variants for {gene_name} and {species_name}")
-
-                enh_prom_object = Variants(
-                    chromosome = int(row["chromosome"]),
-                    category = row["category"],
-                    start = int(row["start_position"]),
-                    end = int(row["end_position"]),
-                    regulatory_sequence_id = reg_seq.id)
-                
-                session.add(enh_prom_object)
-
-            await session.commit()
-
-async def ConservationAnalysisTask(gene_name: str, species_list: List[tuple[int, str]]) -> None:
-    async with async_session() as session:
-        with open(f"app/data/ConservationAnalysis{gene_name}.csv", "r") as file:
-            reader = DictReader(file)
-            gene_id = await genes.get_id(gene_name)
-            for row in reader:
-
-                # add an item to the conservation anaysis table and get its id for use in the conservation sequences table
-                conservation_analysis_object = ConservationScores(gene_id = gene_id, phylop_score = float(row["phylop_score"]), phastcon_score = float(row["phastcon_score"]), position = row["header"])
-                
-                session.add(conservation_analysis_object)
-                await session.flush()
-
-                # add all 3 nucleotides to the conservaiton sequences table
-                for i in range(3):
-                    conservation_sequences_object = ConservationNucleotides(species_id = species_list[i][0], conservation_id = conservation_analysis_object.id, nucleotide = row[species_list[i][1]])
-                    session.add(conservation_sequences_object)
-            
-            await session.commit()
-
-async def load_ConservationAnalysis() -> None:
-        print("loading conservation analysis and sequences tables")
-
-        results = await asyncio.gather(
-            species.get_id("Homo sapiens"),
-            species.get_id("Mus musculus"),
-            species.get_id("Macaca mulatta"))
-
-        species_list = [(results[0], "hg38"),
-                        (results[1], "mm10"),
-                        (results[2], "rheMac3")]
-
-        genes_list = ["DRD4", "ALDH1A3", "CHRNA6"]
-
-        tasks = set()
-
-        # For each gene
-        for gene_name in genes_list:
-            tasks.add(asyncio.create_task(ConservationAnalysisTask(gene_name, species_list)))
-
-        await asyncio.gather(*tasks)
+    if touched("RegulatorySequences", *readiness.ELEMENT_DATASETS):
+        tiles.build_tiles()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Runs before application starts
-    
-    print("Started loading tables")
-
-    # These tables don't depend on anything but everything depends on them so we are running them both at the same time before everything else
-    await asyncio.gather(
-        load_Genes(),
-        load_Species()
-    )
-
-    # These tables both depend on genes and species so we can load these now
-    conservation_analysis_future = load_ConservationAnalysis()
-    regulatory_sequences_future = load_RegulatorySequences()
 
-    # Regulatory elements depends on regulatory sequences so that must be done before we load reg elements
-    await regulatory_sequences_future
+    # The database is filled by app/loader.py, every worker only builds its in memory indexes and caches from it. The
+    # sequence store is memory mapped so all the workers share one copy of it. When serving while the loader runs the
+    # workers take requests straight away and build whatever has been loaded as it comes in, see app/readiness.py
+    watcher = None
 
-    # Make sure all tasks have finished
-    await asyncio.gather(
-        conservation_analysis_future,
-        load_Enh_Prom(),
-        load_TFBS(),
-        load_variants()
-    )
+    if readiness.SERVE_WHILE_LOADING:
+        watcher = asyncio.create_task(readiness.watch(rebuild))
+    else:
+        await readiness.refresh(rebuild)
 
-    print("Finished loading tables")
-    # removing data files since all data is now in database
-    shutil.rmtree("app/data")
     yield
     # Runs after application ends
 
+    if watcher is not None:
+        watcher.cancel()
+        await asyncio.gather(watcher, return_exceptions=True)
+
 
 app = FastAPI(lifespan=lifespan)
 
+# added before CORS so CORS stays the outer middleware and its headers are never cached, compression sits between the
+# two so the cache keeps the uncompressed body and every client can be given the encoding it asked for. The request
+# session is innermost so responses served from the cache never open one. Metrics are outside all of them so they see
+# cache hits and the bytes that are actually sent.
+app.add_middleware(RequestSessionMiddleware)
+app.add_middleware(http_cache.ResponseCacheMiddleware)
+app.add_middleware(compression.CompressionMiddleware)
+app.add_middleware(request_metrics.MetricsMiddleware)
+
 origins = [
     "http://localhost:5432",  # Database
     "http://localhost:3030"   # Frontend
@@ -265,4 +105,7 @@ app.include_router(genes.router)
 app.include_router(species.router)
 app.include_router(regulatory_sequences.router)
 app.include_router(regulatory_elements.router)
-app.include_router(conservation_scores.router)
\ No newline at end of file
+app.include_router(conservation_scores.router)
+app.include_router(browser.router)
+app.include_router(health.router)
+app.include_router(metrics.router)
\ No newline at end of file
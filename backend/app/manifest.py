@@ -0,0 +1,126 @@
+import glob
+import json
+import os
+import re
+from dataclasses import dataclass
+from typing import Any
+
+# Describes which files app/loader.py loads. A data directory is read with the defaults below, which match the layout of
+# app/data, and anything in a manifest.json in it (or a manifest file given directly) overrides them:
+#
+#   {
+#     "genes": "Genes.csv",
+#     "species": "Species.csv",
+#     "regulatory_sequences": "RegulatorySequences.csv",
+#     "sequence_file": "sequences/{species}-{gene}.txt",
+#     "conservation": "conservation/ConservationAnalysis{gene}.csv",
+#     "conservation_columns": {"hg38": "Homo sapiens", "mm10": "Mus musculus"},
+#     "elements": {
+#       "Variants": {"files": "variants/*.tsv", "delimiter": "\t",
+#                    "columns": {"gene": "gene", "species": "species", "chromosome": "chromosome",
+#                                "category": "category", "start": "start_position", "end": "end_position"}}
+#     }
+#   }
+#
+# Paths are relative to the manifest's directory. Conservation files are found by replacing {gene} with a wildcard so
+# every gene with a file is loaded, and element files are glob patterns so a table can be split over any number of files.
+# conservation_columns maps the nucleotide columns of the conservation files to species.
+#
+# Every file a pattern matches is loaded and together they replace the table. The variants are exported as dated files
+# like variants_november_6_2025.tsv, so the default takes any variants_*.tsv: a new export is picked up without editing
+# anything, but the old one has to be removed or both are loaded.
+
+MANIFEST_FILE = "manifest.json"
+
+DEFAULTS: dict[str, Any] = {
+    "genes": "Genes.csv",
+    "species": "Species.csv",
+    "regulatory_sequences": "RegulatorySequences.csv",
+    "sequence_file": "{species}-{gene}.txt",
+    "conservation": "ConservationAnalysis{gene}.csv",
+    "conservation_columns": {"hg38": "Homo sapiens", "mm10": "Mus musculus", "rheMac3": "Macaca mulatta"},
+    "elements": {
+        "EnhancersPromoters": {"files": "Complete_2Mil_Enh_Prom.csv", "delimiter": ",", "description": "enhancers and promoters",
+                               "columns": {"gene": "Gene", "species": "Species", "chromosome": "Chromosome", "category": "Enh_Prom", "start": "Type_Start", "end": "Type_End"}},
+        "TranscriptionFactorBindingSites": {"files": "Complete_TFBS.csv", "delimiter": ",", "description": "Transcription Factor Binding Sites",
+                                            "columns": {"gene": "Gene", "species": "Species", "chromosome": "Chromosome", "category": "Type", "start": "Type_Start", "end": "Type_End"}},
+        "Variants": {"files": "variants_*.tsv", "delimiter": "\t", "description": "variants",
+                     "columns": {"gene": "gene", "species": "species", "chromosome": "chromosome", "category": "category", "start": "start_position", "end": "end_position"}},
+    },
+}
+
+ELEMENT_COLUMNS = ["gene", "species", "chromosome", "category", "start", "end"]
+
+@dataclass
+class ElementFiles:
+    table: str
+    paths: list[str]
+    columns: dict[str, str]
+    delimiter: str
+    description: str
+
+@dataclass
+class Manifest:
+    directory: str
+    genes: str
+    species: str
+    regulatory_sequences: str
+    sequence_file: str
+    # gene name -> conservation file
+    conservation: dict[str, str]
+    # column of the conservation files -> species name
+    conservation_columns: dict[str, str]
+    elements: list[ElementFiles]
+
+    def sequence_path(self, species_name: str, gene_name: str) -> str:
+        return os.path.join(self.directory, self.sequence_file.format(species=species_name, gene=gene_name))
+
+# every file matching the pattern with the gene name taken from the part that replaced {gene}
+def find_gene_files(directory: str, pattern: str) -> dict[str, str]:
+    prefix, _, suffix = pattern.partition("{gene}")
+    matcher = re.compile(re.escape(prefix) + "(.+)" + re.escape(suffix) + "$")
+    files = {}
+
+    for path in sorted(glob.glob(os.path.join(directory, glob.escape(prefix) + "*" + glob.escape(suffix)))):
+        match = matcher.match(os.path.relpath(path, directory))
+        if match is not None:
+            files[match.group(1)] = path
+
+    return files
+
+# Reads the manifest at the path, or the manifest.json in it or just the defaults if it is a directory
+def read_manifest(path: str) -> Manifest:
+    settings: dict[str, Any] = {}
+
+    if os.path.isdir(path):
+        directory = path
+        if os.path.exists(os.path.join(path, MANIFEST_FILE)):
+            with open(os.path.join(path, MANIFEST_FILE), "r") as file:
+                settings = json.load(file)
+    else:
+        directory = os.path.dirname(path)
+        with open(path, "r") as file:
+            settings = json.load(file)
+
+    settings = {**DEFAULTS, **settings}
+
+    elements = []
+    for table, files in settings["elements"].items():
+        missing = [column for column in ELEMENT_COLUMNS if column not in files.get("columns", {})]
+        if missing:
+            raise ValueError(f"elements for {table} in the manifest are missing the columns {missing}")
+
+        elements.append(ElementFiles(table,
+                                     sorted(glob.glob(os.path.join(directory, files["files"]))),
+                                     files["columns"],
+                                     files.get("delimiter", ","),
+                                     files.get("description", table)))
+
+    return Manifest(directory,
+                    os.path.join(directory, settings["genes"]),
+                    os.path.join(directory, settings["species"]),
+                    os.path.join(directory, settings["regulatory_sequences"]),
+                    settings["sequence_file"],
+                    find_gene_files(directory, settings["conservation"]),
+                    settings["conservation_columns"],
+                    elements)
@@ -0,0 +1,85 @@
+from dataclasses import dataclass, field
+from typing import Optional
+from sqlalchemy import select
+from app.models import Genes, RegulatorySequences, Species
+from app.utils import async_session
+
+# Genes, Species and RegulatorySequences only have a handful of rows and never change between loads, so every process
+# keeps a copy of them here and routers resolve names to ids without joining those tables on every query
+
+@dataclass(frozen=True)
+class GeneInfo:
+    id: int
+    name: str
+
+@dataclass(frozen=True)
+class SpeciesInfo:
+    id: int
+    name: str
+    assembly: str
+
+@dataclass(frozen=True)
+class SequenceInfo:
+    id: int
+    gene_name: str
+    species_name: str
+    gene_start: int
+    gene_end: int
+    total_start: int
+    total_end: int
+    allignment_num: int
+
+@dataclass
+class Metadata:
+    genes: dict[str, GeneInfo] = field(default_factory=dict)
+    species: dict[str, SpeciesInfo] = field(default_factory=dict)
+    sequences: dict[tuple[str, str], SequenceInfo] = field(default_factory=dict)
+    # gene name -> the same sequences, so looking up one gene doesn't go through every gene's
+    gene_sequence_lists: dict[str, list[SequenceInfo]] = field(default_factory=dict)
+
+    # every species that has a sequence for this gene, in the order they were loaded
+    def gene_sequences(self, gene_name: str) -> list[SequenceInfo]:
+        return self.gene_sequence_lists.get(gene_name, [])
+
+_metadata: Optional[Metadata] = None
+
+async def refresh_metadata() -> Metadata:
+    global _metadata
+
+    async with async_session() as session:
+        genes = (await session.execute(select(Genes.id, Genes.name).order_by(Genes.id))).tuples().all()
+        species = (await session.execute(select(Species.id, Species.name, Species.assembly).order_by(Species.id))).tuples().all()
+
+        stmt = (select(RegulatorySequences.id, Genes.name, Species.name, RegulatorySequences.gene_start, RegulatorySequences.gene_end,
+                       RegulatorySequences.total_start, RegulatorySequences.total_end, RegulatorySequences.allignment_num)
+                .select_from(RegulatorySequences)
+                .join(Genes)
+                .join(Species)
+                .order_by(RegulatorySequences.id))
+        sequences = (await session.execute(stmt)).tuples().all()
+
+    metadata = Metadata()
+
+    for row in genes:
+        metadata.genes[row[1]] = GeneInfo(*row)
+
+    for row in species:
+        metadata.species[row[1]] = SpeciesInfo(*row)
+
+    for row in sequences:
+        sequence = SequenceInfo(*row)
+        metadata.sequences[(row[1], row[2])] = sequence
+        metadata.gene_sequence_lists.setdefault(row[1], []).append(sequence)
+
+    # replaced in one go so readers never see a partially filled registry
+    _metadata = metadata
+
+    return metadata
+
+# Returns the registry, reading it from the database the first time it is needed
+async def get_metadata() -> Metadata:
+    if _metadata is None:
+        # two requests racing here both just read the same rows so there is no need to lock
+        return await refresh_metadata()
+
+    return _metadata
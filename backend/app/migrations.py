@@ -0,0 +1,65 @@
+import asyncio
+from sqlalchemy import text
+from app.utils import async_engine
+
+# Schema changes on top of database/database.sql. database.sql only runs when the db volume is first created
+# so anything added after that lives here, every statement has to be safe to run again on every start.
+SCHEMA_CHANGES = [
+    'CREATE INDEX IF NOT EXISTS "RegulatorySequences_gene_species_idx" ON "RegulatorySequences" ("gene_id", "species_id")',
+
+    # every element query filters on the sequence and category and then on start/end
+    'CREATE INDEX IF NOT EXISTS "EnhancersPromoters_sequence_category_start_idx" ON "EnhancersPromoters" ("regulatory_sequence_id", "category", "start")',
+    'CREATE INDEX IF NOT EXISTS "TranscriptionFactorBindingSites_sequence_category_start_idx" ON "TranscriptionFactorBindingSites" ("regulatory_sequence_id", "category", "start")',
+    'CREATE INDEX IF NOT EXISTS "Variants_sequence_category_start_idx" ON "Variants" ("regulatory_sequence_id", "category", "start")',
+
+    # range indexes for the overlap predicate, the expression has to match get_elements exactly to be used.
+    # These only cover the range since gist needs the btree_gist extension to index the sequence id as well
+    'CREATE INDEX IF NOT EXISTS "EnhancersPromoters_range_idx" ON "EnhancersPromoters" USING gist (int8range("start", "end", \'[]\'))',
+    'CREATE INDEX IF NOT EXISTS "TranscriptionFactorBindingSites_range_idx" ON "TranscriptionFactorBindingSites" USING gist (int8range("start", "end", \'[]\'))',
+    'CREATE INDEX IF NOT EXISTS "Variants_range_idx" ON "Variants" USING gist (int8range("start", "end", \'[]\'))',
+
+    # position is text like bp_10 so it sorts as bp_1, bp_10, bp_2, the number is stored separately to order by. Only
+    # runs until the column is NOT NULL, altering the table locks it and the server may be reading it while the loader
+    # starts
+    '''DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_name = 'ConservationScores' AND column_name = 'position_number' AND is_nullable = 'NO') THEN
+            ALTER TABLE "ConservationScores" ADD COLUMN IF NOT EXISTS "position_number" INTEGER;
+            UPDATE "ConservationScores" SET "position_number" = CAST(substring("position" from '[0-9]+$') AS INTEGER) WHERE "position_number" IS NULL;
+            ALTER TABLE "ConservationScores" ALTER COLUMN "position_number" SET NOT NULL;
+        END IF;
+    END $$''',
+    'DROP INDEX IF EXISTS "ConservationScores_gene_position_idx"',
+    'CREATE INDEX IF NOT EXISTS "ConservationScores_gene_position_number_idx" ON "ConservationScores" ("gene_id", "position_number")',
+    'CREATE INDEX IF NOT EXISTS "ConservationNucleotides_conservation_species_idx" ON "ConservationNucleotides" ("conservation_id", "species_id")',
+
+    # fingerprints of the loaded source files so app/loader.py can skip datasets that haven't changed
+    'CREATE TABLE IF NOT EXISTS "LoadedDatasets" ("name" VARCHAR(255) NOT NULL, "fingerprint" VARCHAR(64) NOT NULL, "loaded_at" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(), PRIMARY KEY("name"))',
+
+    # what the loader is doing right now so the server can serve while it runs, see app/readiness.py
+    'CREATE TABLE IF NOT EXISTS "LoadingDatasets" ("name" VARCHAR(255) NOT NULL, "state" VARCHAR(16) NOT NULL, "updated_at" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(), "error" TEXT, PRIMARY KEY("name"))',
+]
+
+# Has to run before anything is loaded since the loaders write to the columns added here
+async def apply_migrations() -> None:
+    print("applying schema changes")
+
+    async with async_engine.begin() as connection:
+        for statement in SCHEMA_CHANGES:
+            await connection.execute(text(statement))
+
+# refreshes the planner statistics, worth doing after the tables have been bulk loaded
+async def analyze() -> None:
+    async with async_engine.connect() as connection:
+        await connection.execute(text("ANALYZE"))
+        await connection.commit()
+
+async def main() -> None:
+    await apply_migrations()
+    await analyze()
+    await async_engine.dispose()
+
+# python -m app.migrations applies the schema changes without starting the server
+if __name__ == "__main__":
+    asyncio.run(main())
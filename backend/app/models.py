@@ -1,5 +1,6 @@
-from typing import List
-from sqlalchemy import String, Integer, ForeignKey, BigInteger, CheckConstraint, CHAR, Text, DECIMAL
+from datetime import datetime
+from typing import List, Optional
+from sqlalchemy import String, Integer, ForeignKey, BigInteger, CheckConstraint, CHAR, Text, DECIMAL, DateTime
 from sqlalchemy.orm import Mapped, DeclarativeBase, relationship, mapped_column
 from sqlalchemy.ext.asyncio import AsyncAttrs
 
@@ -116,6 +117,7 @@ class ConservationScores(Base):
     phylop_score: Mapped[float] = mapped_column(DECIMAL)
     phastcon_score: Mapped[float] = mapped_column(DECIMAL)
     position: Mapped[str] = mapped_column(String(255))
+    position_number: Mapped[int] = mapped_column(Integer)
 
     # Relationships
     gene_fk: Mapped[Genes] = relationship(back_populates="conservation_analysis_fk")
@@ -138,3 +140,23 @@ class ConservationNucleotides(Base):
 
 
             
+
+
+# One row per source dataset with the fingerprint of the files it was last loaded from, see app/loader.py
+class LoadedDatasets(Base):
+    __tablename__ = "LoadedDatasets"
+
+    name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    fingerprint: Mapped[str] = mapped_column(String(64))
+    loaded_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+
+# One row per dataset app/loader.py is loading right now, removed once it is in LoadedDatasets. Workers serving while the
+# loader runs report these through /health/ready, see app/readiness.py
+class LoadingDatasets(Base):
+    __tablename__ = "LoadingDatasets"
+
+    name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    # waiting, loading or failed
+    state: Mapped[str] = mapped_column(String(16))
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
\ No newline at end of file
@@ -0,0 +1,118 @@
+import struct
+from array import array
+from typing import Literal
+from fastapi import Response
+
+# Compact binary encoding for the large track payloads, returned instead of JSON when an endpoint is called with
+# format=packed. Everything is little endian and laid out in columns so a browser can wrap every column in a typed array
+# without copying, which is why every section starts on a 4 byte boundary.
+#
+#   header        16 bytes  magic "CRGP", u8 version (1), u8 kind, u16 string count, u32 record count, u32 reserved
+#   string table            every string as a u16 byte length followed by its utf-8 bytes, padded to 4 bytes
+#   columns                 depending on kind, each padded to 4 bytes
+#
+#   kind 1 elements             u16 type[n], i32 chromosome[n], i32 start[n], i32 end[n]
+#   kind 2 segments             u16 type[n], i32 chromosome[n], i32 start[n], i32 end[n], f32 width[n]
+#   kind 3 sequence             n ascii bases, no string table
+#   kind 4 binned track         f64 start, f64 end, f64 bin width, u16 type[n], i32 count[n]
+#   kind 5 nucleotide segments  u16 type[n], f32 width[n]
+#
+# type columns are indexes into the string table, which holds every distinct type once.
+
+MEDIA_TYPE = "application/vnd.crg.packed"
+
+# the format query parameter of the endpoints that can answer either way
+Format = Literal["json", "packed"]
+
+MAGIC = b"CRGP"
+VERSION = 1
+
+HEADER = struct.Struct("<4sBBHII")
+
+ELEMENTS = 1
+SEGMENTS = 2
+SEQUENCE = 3
+BINNED = 4
+NUCLEOTIDE_SEGMENTS = 5
+
+def _pad(data: bytes) -> bytes:
+    return data + b"\0" * (-len(data) % 4)
+
+def _column(typecode: str, values) -> bytes:
+    column = array(typecode, values)
+
+    # array uses the machine's byte order and the format is little endian everywhere
+    if column.itemsize > 1 and struct.pack("=H", 1) != struct.pack("<H", 1):
+        column.byteswap()
+
+    return _pad(column.tobytes())
+
+# Returns the string table and the index of every string in it
+def _strings(values: list[str]) -> tuple[list[str], list[int]]:
+    table: dict[str, int] = {}
+    indexes = [table.setdefault(value, len(table)) for value in values]
+
+    return list(table), indexes
+
+def _pack(kind: int, strings: list[str], count: int, *sections: bytes) -> bytes:
+    encoded = [string.encode() for string in strings]
+    table = _pad(b"".join(struct.pack("<H", len(string)) + string for string in encoded))
+
+    return b"".join([HEADER.pack(MAGIC, VERSION, kind, len(strings), count, 0), table, *sections])
+
+def elements(element_list: list) -> bytes:
+    strings, types = _strings([element.type for element in element_list])
+
+    return _pack(ELEMENTS, strings, len(element_list),
+                 _column("H", types),
+                 _column("i", [element.chromosome for element in element_list]),
+                 _column("i", [element.start for element in element_list]),
+                 _column("i", [element.end for element in element_list]))
+
+def segments(segment_list: list) -> bytes:
+    strings, types = _strings([segment.type for segment in segment_list])
+
+    return _pack(SEGMENTS, strings, len(segment_list),
+                 _column("H", types),
+                 _column("i", [segment.chromosome for segment in segment_list]),
+                 _column("i", [segment.start for segment in segment_list]),
+                 _column("i", [segment.end for segment in segment_list]),
+                 _column("f", [segment.width for segment in segment_list]))
+
+def sequence(bases: str) -> bytes:
+    return _pack(SEQUENCE, [], len(bases), bases.encode("ascii"))
+
+def binned(track) -> bytes:
+    strings, types = _strings(track.types)
+
+    return _pack(BINNED, strings, len(track.types),
+                 struct.pack("<ddd", track.start, track.end, track.bin_width),
+                 _column("H", types),
+                 _column("i", track.counts))
+
+def nucleotide_segments(segment_list: list) -> bytes:
+    strings, types = _strings([segment.type for segment in segment_list])
+
+    return _pack(NUCLEOTIDE_SEGMENTS, strings, len(segment_list),
+                 _column("H", types),
+                 _column("f", [segment.width for segment in segment_list]))
+
+# One segment per base, all of the same width, made by translating the bases to their string table indexes instead of
+# going through a segment per base
+def nucleotide_letters(bases: str) -> bytes:
+    # in the order they first appear, the same table nucleotide_segments makes
+    strings = sorted(set(bases), key=bases.index)
+    # there are fewer than 256 letters so every u16 index is written as its low byte and a zero byte
+    types = bases.translate({ord(base): chr(index) + "\0" for index, base in enumerate(strings)}).encode("latin-1")
+    width = (1 / len(bases)) * 100 if bases else 0.0
+
+    return _pack(NUCLEOTIDE_SEGMENTS, strings, len(bases),
+                 _pad(types),
+                 _column("f", array("f", [width]) * len(bases)))
+
+# a mapped track is either a list of segments or a binned track depending on whether bins was given
+def track(value) -> bytes:
+    return segments(value) if isinstance(value, list) else binned(value)
+
+def response(data: bytes) -> Response:
+    return Response(content=data, media_type=MEDIA_TYPE)
@@ -0,0 +1,194 @@
+import asyncio
+import math
+import os
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+from fastapi import HTTPException, Request
+from app import bulk_load, http_cache
+from app.metadata import get_metadata
+
+# Lets the server take requests while app/loader.py is still filling the database. Every worker polls LoadedDatasets and
+# LoadingDatasets and rebuilds the in memory state of whatever finished loading since the last poll (see rebuild in
+# app/main.py). Until a dataset is built in this worker the routers that read it answer right away with 503, what is
+# still loading and a Retry-After header, instead of waiting for it or answering with missing data, and the loader is
+# asked to load it next. /health/ready reports the state of every table and gene.
+#
+# Conservation analyses are loaded per gene so a gene that is asked for jumps ahead of the others. The sequence and
+# element tables are loaded whole, every gene becomes ready with them at the same time.
+
+# when false the workers build everything before they take requests, which is how it works when the loader has filled
+# the database before the server is started
+SERVE_WHILE_LOADING = os.environ.get("SERVE_WHILE_LOADING", "false").lower() in ("1", "true", "yes")
+
+# how often the workers check for newly loaded datasets while serving
+READINESS_POLL_SECONDS = float(os.environ.get("READINESS_POLL_SECONDS", 2))
+
+# nothing can be served without these
+REQUIRED_DATASETS = ["Genes", "Species", "RegulatorySequences"]
+
+ELEMENT_DATASETS = ["EnhancersPromoters", "TranscriptionFactorBindingSites", "Variants"]
+
+CONSERVATION_PREFIX = "ConservationAnalysis "
+
+def conservation_dataset(gene_name: str) -> str:
+    return CONSERVATION_PREFIX + gene_name
+
+# states of a dataset that can be served, every other state makes the requests that need it wait
+SERVED_STATES = ("ready", "reloading")
+
+@dataclass
+class DatasetState:
+    # ready, reloading (ready and being loaded again), building (loaded but not in this worker's memory yet), waiting,
+    # loading, failed, missing (never loaded and not being loaded) or starting (nothing has been read yet)
+    state: str
+    since: Optional[datetime] = None
+    error: Optional[str] = None
+
+# dataset name -> fingerprint of what this worker's in memory state was built from, None until the first build
+_served: Optional[dict[str, str]] = None
+
+# LoadedDatasets and LoadingDatasets as of the last poll
+_loaded: dict[str, str] = {}
+_loading: dict[str, tuple[str, datetime, Optional[str]]] = {}
+
+# datasets this worker has asked the loader for since the last poll, so a burst of requests only asks once
+_requested: set[str] = set()
+
+def dataset_state(name: str) -> DatasetState:
+    loading = _loading.get(name)
+
+    if _served is None:
+        return DatasetState("starting")
+
+    if name in _served:
+        # the old copy is served until the new one is built, a failed reload keeps serving it
+        if loading is not None and loading[0] != "failed":
+            return DatasetState("reloading", loading[1])
+        return DatasetState("ready", None, loading[2] if loading is not None else None)
+
+    if loading is not None:
+        return DatasetState(*loading)
+
+    if name in _loaded:
+        return DatasetState("building")
+
+    return DatasetState("missing")
+
+# The datasets out of names that requests have to wait for. One that is missing is only waited for if it is required,
+# the others may just not exist for this data, like the conservation analysis of a gene that has none.
+def waiting_for(names: list[str]) -> dict[str, DatasetState]:
+    waiting = {}
+
+    for name in names:
+        state = dataset_state(name)
+
+        if state.state not in SERVED_STATES and (state.state != "missing" or name in REQUIRED_DATASETS):
+            waiting[name] = state
+
+    return waiting
+
+def gene_datasets(gene_name: str) -> list[str]:
+    return REQUIRED_DATASETS + ELEMENT_DATASETS + [conservation_dataset(gene_name)]
+
+# every dataset that has been or is being loaded except for the conservation analyses, which are reported per gene
+def table_names() -> list[str]:
+    names = set(REQUIRED_DATASETS) | set(_loaded) | set(_loading) | set(_served or {})
+    return sorted(name for name in names if not name.startswith(CONSERVATION_PREFIX))
+
+# every gene that has been or is being loaded
+async def gene_names() -> list[str]:
+    names = {name[len(CONSERVATION_PREFIX):] for name in set(_loaded) | set(_loading) | set(_served or {}) if name.startswith(CONSERVATION_PREFIX)}
+
+    if dataset_state("Genes").state in SERVED_STATES:
+        names |= set((await get_metadata()).genes)
+
+    return sorted(names)
+
+async def ask_loader(names: list[str]) -> None:
+    names = [name for name in names if name not in _requested]
+
+    if not names:
+        return
+
+    _requested.update(names)
+
+    try:
+        await bulk_load.request_priority(names)
+    except Exception as error:
+        # the request is answered with 503 either way, the dataset is just loaded in its turn
+        print(f"couldn't ask the loader for {', '.join(names)}: {error}")
+
+# Dependency for routers that read the given datasets, and the gene's conservation analysis if conservation is set.
+# The gene is the gene_name query parameter or the gene_name of a JSON body.
+def requires(*datasets: str, conservation: bool = False):
+
+    async def check(request: Request) -> None:
+        if not SERVE_WHILE_LOADING:
+            return
+
+        gene_name = request.query_params.get("gene_name")
+
+        if gene_name is None and request.headers.get("content-type", "").startswith("application/json"):
+            try:
+                body = await request.json()
+            except ValueError:
+                # left for the endpoint to reject
+                body = None
+
+            if isinstance(body, dict) and isinstance(body.get("gene_name"), str):
+                gene_name = body["gene_name"]
+
+        names = list(datasets)
+        if conservation and gene_name is not None:
+            names.append(conservation_dataset(gene_name))
+
+        waiting = waiting_for(names)
+
+        if not waiting:
+            return
+
+        await ask_loader([name for name, state in waiting.items() if state.state == "waiting"])
+
+        raise HTTPException(status_code=503,
+                            detail={"status": "loading",
+                                    "gene_name": gene_name,
+                                    "datasets": {name: state.state for name, state in waiting.items()}},
+                            headers={"Retry-After": str(math.ceil(READINESS_POLL_SECONDS))})
+
+    return check
+
+# Reads what has been loaded and calls rebuild with the names of the datasets that changed since the last call, or with
+# None the first time so everything is built. The datasets only count as served once rebuild has returned.
+async def refresh(rebuild: Callable[[Optional[set[str]]], Awaitable[None]]) -> None:
+    global _served, _loaded, _loading
+
+    # read before rebuild reads the tables, a dataset that finishes in between is built now and counted at the next poll
+    loaded = await bulk_load.loaded_fingerprints()
+    _loading = await bulk_load.loading_states()
+    _loaded = loaded
+    _requested.clear()
+
+    if _served is None:
+        changed = None
+    else:
+        changed = {name for name in set(loaded) | set(_served) if loaded.get(name) != _served.get(name)}
+
+        if not changed:
+            return
+
+    await rebuild(changed)
+
+    _served = loaded
+    http_cache.set_dataset_version(http_cache.version_of(loaded))
+
+# Polls for newly loaded datasets until it is cancelled
+async def watch(rebuild: Callable[[Optional[set[str]]], Awaitable[None]]) -> None:
+    while True:
+        try:
+            await refresh(rebuild)
+        except Exception as error:
+            # most likely the loader hasn't created the tables yet
+            print(f"couldn't refresh the loaded datasets, trying again in {READINESS_POLL_SECONDS}s: {str(error).splitlines()[0] if str(error) else repr(error)}")
+
+        await asyncio.sleep(READINESS_POLL_SECONDS)
@@ -0,0 +1,266 @@
+import functools
+import inspect
+import os
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Optional
+from fastapi.routing import APIRoute
+from app.utils import QueryStats, async_engine, collect_queries, pool_metrics
+
+# Per route numbers of where a request's time went: the queries it ran (from the engine events in app/utils.py), reading
+# the request and running its dependencies, the endpoint function itself, validating and serializing its result, and the
+# bytes sent back. They are served in the
+# Prometheus text format on /metrics. Every worker keeps its own numbers, so with more than one worker each scrape only
+# sees the worker that answered it.
+
+# adds a Server-Timing header with the same breakdown to every response, which browsers show in the network panel
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+
+# requests slower than this are logged with every statement they ran, a negative value turns the log off
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", 1))
+
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+@dataclass
+class RequestMetrics:
+    queries: QueryStats
+    # path of the route that handled the request, None when it never got to one (cache hits, 404s)
+    route: Optional[str] = None
+    handler_seconds: float = 0.0
+    # when the endpoint function was called and returned, None if a dependency answered first
+    handler_started: Optional[float] = None
+    handler_finished: Optional[float] = None
+    # what FastAPI does before the endpoint function (reading the body, validating parameters, the readiness check and
+    # other dependencies) and after it (validating and serializing the result)
+    dependency_seconds: float = 0.0
+    serialization_seconds: float = 0.0
+
+@dataclass
+class RouteMetrics:
+    statuses: dict[int, int] = field(default_factory=dict)
+    buckets: list[int] = field(default_factory=lambda: [0] * len(DURATION_BUCKETS))
+    requests: int = 0
+    seconds: float = 0.0
+    queries: int = 0
+    db_seconds: float = 0.0
+    rows: int = 0
+    handler_seconds: float = 0.0
+    dependency_seconds: float = 0.0
+    serialization_seconds: float = 0.0
+    response_bytes: int = 0
+
+# (method, route) -> metrics
+routes: dict[tuple[str, str], RouteMetrics] = {}
+
+# path of every MeasuredRoute, requests that never got to a route are only labelled by their path if it is one of these
+route_paths: set[str] = set()
+
+_request_metrics: ContextVar[Optional[RequestMetrics]] = ContextVar("request_metrics", default=None)
+
+# Times the endpoint function on its own, FastAPI unwraps it to read the signature so parameters work as before
+def measured_endpoint(endpoint):
+    # include_router builds the app's routes from the router's, whose endpoints are already wrapped
+    if getattr(endpoint, "measured", False):
+        return endpoint
+
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def measured(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                record_handler(start, perf_counter())
+    else:
+        @functools.wraps(endpoint)
+        def measured(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                record_handler(start, perf_counter())
+
+    measured.measured = True
+
+    return measured
+
+def record_handler(start: float, end: float) -> None:
+    metrics = _request_metrics.get()
+
+    if metrics is not None:
+        metrics.handler_seconds += end - start
+        metrics.handler_started = start
+        metrics.handler_finished = end
+
+# Route class of every router, it records which route handled the request and how long FastAPI spent on it before and
+# after the endpoint function
+class MeasuredRoute(APIRoute):
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, measured_endpoint(endpoint), **kwargs)
+        route_paths.add(self.path)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        path = self.path
+
+        async def measured_handler(request):
+            metrics = _request_metrics.get()
+            start = perf_counter()
+
+            try:
+                return await handler(request)
+            finally:
+                if metrics is not None:
+                    end = perf_counter()
+                    metrics.route = path
+
+                    if metrics.handler_finished is None:
+                        metrics.dependency_seconds = end - start
+                    else:
+                        metrics.dependency_seconds = metrics.handler_started - start
+                        metrics.serialization_seconds = end - metrics.handler_finished
+
+        return measured_handler
+
+def server_timing(metrics: RequestMetrics, seconds: float) -> bytes:
+    timings = [f'db;dur={metrics.queries.seconds * 1000:.1f};desc="{metrics.queries.count} queries"']
+
+    if metrics.route is not None:
+        timings += [f"dependencies;dur={metrics.dependency_seconds * 1000:.1f}", f"handler;dur={metrics.handler_seconds * 1000:.1f}",
+                    f"serialize;dur={metrics.serialization_seconds * 1000:.1f}"]
+
+    timings.append(f"total;dur={seconds * 1000:.1f}")
+
+    return ", ".join(timings).encode()
+
+def record(method: str, route: str, status: int, seconds: float, response_bytes: int, metrics: RequestMetrics) -> None:
+    route_metrics = routes.setdefault((method, route), RouteMetrics())
+
+    route_metrics.statuses[status] = route_metrics.statuses.get(status, 0) + 1
+    route_metrics.requests += 1
+    route_metrics.seconds += seconds
+    route_metrics.queries += metrics.queries.count
+    route_metrics.db_seconds += metrics.queries.seconds
+    route_metrics.rows += metrics.queries.rows
+    route_metrics.handler_seconds += metrics.handler_seconds
+    route_metrics.dependency_seconds += metrics.dependency_seconds
+    route_metrics.serialization_seconds += metrics.serialization_seconds
+    route_metrics.response_bytes += response_bytes
+
+    for i, bound in enumerate(DURATION_BUCKETS):
+        if seconds <= bound:
+            route_metrics.buckets[i] += 1
+
+def log_slow_request(method: str, target: str, seconds: float, metrics: RequestMetrics) -> None:
+    print(f"slow request {method} {target} took {seconds * 1000:.0f}ms, {metrics.queries.count} queries took "
+          f"{metrics.queries.seconds * 1000:.0f}ms, dependencies {metrics.dependency_seconds * 1000:.0f}ms, handler {metrics.handler_seconds * 1000:.0f}ms, serialization {metrics.serialization_seconds * 1000:.0f}ms")
+
+    for statement, statement_seconds in metrics.queries.statements:
+        print(f"  {statement_seconds * 1000:8.1f}ms {' '.join(statement.split())}")
+
+    if metrics.queries.count > len(metrics.queries.statements):
+        print(f"  ... {metrics.queries.count - len(metrics.queries.statements)} more statements")
+
+# Plain ASGI middleware so the bytes of streamed responses are counted as they are sent and the request is only recorded
+# once the last chunk is out
+class MetricsMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = perf_counter()
+        status = 500
+        response_bytes = 0
+
+        with collect_queries() as queries:
+            metrics = RequestMetrics(queries)
+            token = _request_metrics.set(metrics)
+
+            async def measure_response(message):
+                nonlocal status, response_bytes
+
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+
+                    if SERVER_TIMING:
+                        headers = list(message.get("headers", [])) + [(b"server-timing", server_timing(metrics, perf_counter() - start))]
+                        message = {**message, "headers": headers}
+
+                elif message["type"] == "http.response.body":
+                    response_bytes += len(message.get("body", b""))
+
+                await send(message)
+
+            try:
+                await self.app(scope, receive, measure_response)
+            finally:
+                _request_metrics.reset(token)
+
+                seconds = perf_counter() - start
+
+                # requests that never reached a route (cache hits) are labelled by their path, there are no path
+                # parameters so this is the same label the route would have had. Any other path gets the same label so
+                # made up URLs can't add labels without end.
+                route = metrics.route or (scope["path"] if scope["path"] in route_paths else "unmatched")
+                record(scope["method"], route, status, seconds, response_bytes, metrics)
+
+                if 0 <= SLOW_REQUEST_SECONDS <= seconds:
+                    query_string = scope.get("query_string", b"").decode("latin-1")
+                    log_slow_request(scope["method"], scope["path"] + (f"?{query_string}" if query_string else ""), seconds, metrics)
+
+def label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# The metrics of every route and of the connection pool in the Prometheus text format
+def render() -> str:
+    lines = []
+
+    def metric(name: str, kind: str, description: str, samples: list[tuple[str, float]]) -> None:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(f"{name}{labels} {value}" for labels, value in samples)
+
+    ordered = sorted(routes.items())
+
+    def per_route(attribute: str) -> list[tuple[str, float]]:
+        return [(f'{{method="{label(method)}",route="{label(route)}"}}', getattr(route_metrics, attribute))
+                for (method, route), route_metrics in ordered]
+
+    metric("crg_http_requests_total", "counter", "Requests by route and response status",
+           [(f'{{method="{label(method)}",route="{label(route)}",status="{status}"}}', count)
+            for (method, route), route_metrics in ordered for status, count in sorted(route_metrics.statuses.items())])
+
+    duration = []
+    for (method, route), route_metrics in ordered:
+        labels = f'method="{label(method)}",route="{label(route)}"'
+        duration += [(f'_bucket{{{labels},le="{bound}"}}', count) for bound, count in zip(DURATION_BUCKETS, route_metrics.buckets)]
+        duration += [(f'_bucket{{{labels},le="+Inf"}}', route_metrics.requests),
+                     (f"_sum{{{labels}}}", route_metrics.seconds),
+                     (f"_count{{{labels}}}", route_metrics.requests)]
+    metric("crg_http_request_duration_seconds", "histogram", "Time from receiving a request to sending the last byte of its response", duration)
+
+    metric("crg_db_queries_total", "counter", "Statements run against the database", per_route("queries"))
+    metric("crg_db_query_seconds_total", "counter", "Time spent running statements", per_route("db_seconds"))
+    metric("crg_db_rows_total", "counter", "Rows returned or changed by statements", per_route("rows"))
+    metric("crg_dependency_seconds_total", "counter", "Time spent reading and validating requests and running dependencies before the endpoint functions", per_route("dependency_seconds"))
+    metric("crg_handler_seconds_total", "counter", "Time spent in the endpoint functions", per_route("handler_seconds"))
+    metric("crg_serialization_seconds_total", "counter", "Time spent validating and serializing endpoint results after the endpoint functions return", per_route("serialization_seconds"))
+    metric("crg_response_bytes_total", "counter", "Response body bytes sent, after compression", per_route("response_bytes"))
+
+    pool = async_engine.pool
+    metric("crg_db_pool_checked_out", "gauge", "Connections currently in use", [("", pool.checkedout())])
+    metric("crg_db_pool_checked_in", "gauge", "Idle connections in the pool", [("", pool.checkedin())])
+    metric("crg_db_pool_checkouts_total", "counter", "Connections handed out", [("", pool_metrics.checkouts)])
+    metric("crg_db_pool_timeouts_total", "counter", "Checkouts that gave up waiting for a connection", [("", pool_metrics.timeouts)])
+    metric("crg_db_pool_wait_seconds_total", "counter", "Time spent waiting for a connection", [("", pool_metrics.wait_seconds_total)])
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,65 @@
+import asyncio
+from typing import Literal, Optional, Union
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel, Field
+from app.models import EnhancersPromoters, TranscriptionFactorBindingSites, Variants
+from app.routers import regulatory_sequences, regulatory_elements
+from app.routers.regulatory_elements import BinnedTrack, Segment
+from app.routers.regulatory_sequences import NucleotideSegment, Offsets
+from app.metadata import get_metadata
+from app.request_metrics import MeasuredRoute
+from app import readiness
+
+class TrackRequest(BaseModel):
+    species_name: str = Field(..., description="species this track is drawn for")
+    track: Literal["Enh_Prom", "TFBS", "Variants", "nucleotides"] = Field(..., description="which track to map")
+    categories: list[str] = Field([], description="element or variant types to include, not used by the nucleotides track")
+    start: Optional[int] = Field(None, description="start of this track's window if it is different from the view's")
+    end: Optional[int] = Field(None, description="end of this track's window if it is different from the view's")
+    show_letters: bool = Field(False, description="one segment per base for the nucleotides track instead of one per run")
+
+class ViewRequest(BaseModel):
+    gene_name: str = Field(..., description="gene the whole view is for")
+    start: int = Field(..., description="start of the window")
+    end: int = Field(..., description="end of the window")
+    bins: Optional[int] = Field(None, description="number of bins for the element tracks, segments for every element if not given")
+    tracks: list[TrackRequest] = Field(..., description="every track in the view")
+
+class ViewResponse(BaseModel):
+    offsets: Offsets = Field(..., description="offsets of every species of the gene")
+    tracks: list[Union[BinnedTrack, list[Segment], list[NucleotideSegment]]] = Field(..., description="the mapped tracks in the same order they were requested")
+
+router = APIRouter(prefix="/browser", route_class=MeasuredRoute, dependencies=[Depends(readiness.requires(*readiness.REQUIRED_DATASETS, *readiness.ELEMENT_DATASETS))])
+
+TRACK_MODELS = {
+    "Enh_Prom": EnhancersPromoters,
+    "TFBS": TranscriptionFactorBindingSites,
+    "Variants": Variants,
+}
+
+# Everything the browser draws for one pan or zoom in a single request. The offsets are looked up once for the whole
+# view and all the tracks are mapped concurrently with the same functions the single track endpoints use
+@router.post("/view", response_model=ViewResponse)
+async def get_view(view: ViewRequest) -> ViewResponse:
+
+    metadata = await get_metadata()
+
+    for track in view.tracks:
+        if (view.gene_name, track.species_name) not in metadata.sequences:
+            raise HTTPException(status_code=404, detail=f"Unable to find sequence for {view.gene_name} and {track.species_name}")
+
+    offsets = await regulatory_sequences.get_sequence_offsets(view.gene_name)
+
+    tracks = await asyncio.gather(*[map_track(view, track, offsets) for track in view.tracks])
+
+    return ViewResponse(offsets = offsets, tracks = list(tracks))
+
+async def map_track(view: ViewRequest, track: TrackRequest, offsets: Offsets) -> Union[BinnedTrack, list[Segment], list[NucleotideSegment]]:
+
+    start = track.start if track.start is not None else view.start
+    end = track.end if track.end is not None else view.end
+
+    if track.track == "nucleotides":
+        return await regulatory_sequences.get_mapped_nucleotides(view.gene_name, track.species_name, start, end, track.show_letters)
+
+    return await regulatory_elements.get_mapped_elements(TRACK_MODELS[track.track], view.gene_name, track.species_name, track.categories, start, end, view.bins, offsets)
\ No newline at end of file
@@ -1,39 +1,152 @@
-from fastapi import APIRouter, HTTPException
-from typing import List
-from sqlalchemy import select
-from app.models import ConservationNucleotides, ConservationScores, Genes, Species
+from fastapi import APIRouter, Depends, HTTPException
+from typing import List, Optional
+from sqlalchemy import Float, cast, select
+from app.models import ConservationNucleotides, ConservationScores
 from app.utils import async_session
+from app.metadata import get_metadata
+from app.request_metrics import MeasuredRoute
+from app import readiness
 from pydantic import BaseModel, Field
 
-router = APIRouter(prefix="/conservation_scores")
+router = APIRouter(prefix="/conservation_scores", route_class=MeasuredRoute, dependencies=[Depends(readiness.requires("Genes", "Species", conservation=True))])
+
+class HistogramColumns(BaseModel):
+    nucleotides: str = Field(..., description="The nucleotide at every position, one letter each")
+    phastcon_scores: list[float] = Field(..., description="The phastcon_score for every position")
+    phylop_scores: list[float] = Field(..., description="The phylop_score for every position")
+
+class ConservationMatrix(BaseModel):
+    positions: list[int] = Field(..., description="The position of every column of the alignment")
+    species: list[str] = Field(..., description="Every species in the alignment")
+    nucleotides: dict[str, str] = Field(..., description="Dictionary mapping species to their nucleotide at every position, one letter each, a blank where the conservation file has no letter for the species and - where it has no row for the position")
+    phastcon_scores: list[float] = Field(..., description="The phastcon_score for every position")
+    phylop_scores: list[float] = Field(..., description="The phylop_score for every position")
 
 class HistogramData(BaseModel):
     nucleotide: str = Field(..., description="The single letter nucleotide")
     phastcon_score: float = Field(..., description="The phastcon_score for this position")
     phylop_score: float = Field(..., description="The phylop_score for this position")
 
-# This gets the scores in a sorted list for creating a histogram for a given species
-@router.get("/histogram_data", response_model=List[HistogramData])
-async def get_histogram_data(species_name: str, gene_name: str) -> List[HistogramData]:
+# gene name -> the whole alignment for that gene, filled by refresh_matrices once the tables are loaded
+_matrices: dict[str, ConservationMatrix] = {}
+
+# Builds the matrix of every gene from two queries and replaces the cache, has to be called again whenever the tables are reloaded.
+# Given genes only the matrices of those are rebuilt and the rest are kept.
+async def refresh_matrices(only_genes: Optional[list[str]] = None) -> None:
+    global _matrices
+
+    metadata = await get_metadata()
+    gene_names = {gene.id: gene.name for gene in metadata.genes.values()}
+    species_names = {species.id: species.name for species in metadata.species.values()}
+
+    async with async_session() as session:
+        stmt = (select(ConservationScores.gene_id, ConservationScores.id, ConservationScores.position_number,
+                       cast(ConservationScores.phastcon_score, Float), cast(ConservationScores.phylop_score, Float))
+                .order_by(ConservationScores.gene_id, ConservationScores.position_number))
+        nucleotides_stmt = select(ConservationNucleotides.conservation_id, ConservationNucleotides.species_id, ConservationNucleotides.nucleotide)
+
+        if only_genes is not None:
+            gene_ids = [metadata.genes[gene_name].id for gene_name in only_genes if gene_name in metadata.genes]
+            stmt = stmt.where(ConservationScores.gene_id.in_(gene_ids))
+            nucleotides_stmt = nucleotides_stmt.where(ConservationNucleotides.conservation_id.in_(
+                select(ConservationScores.id).where(ConservationScores.gene_id.in_(gene_ids))))
+
+        scores = (await session.execute(stmt)).tuples().all()
+        nucleotides = (await session.execute(nucleotides_stmt)).tuples().all()
+
+    columns: dict[str, dict] = {}
+
+    # conservation id -> (gene name, column in that gene's matrix)
+    locations: dict[int, tuple[str, int]] = {}
+
+    for gene_id, conservation_id, position, phastcon_score, phylop_score in scores:
+        gene_columns = columns.setdefault(gene_names[gene_id], {"positions": [], "phastcon_scores": [], "phylop_scores": [], "nucleotides": {}})
+
+        locations[conservation_id] = (gene_names[gene_id], len(gene_columns["positions"]))
+        gene_columns["positions"].append(position)
+        gene_columns["phastcon_scores"].append(phastcon_score)
+        gene_columns["phylop_scores"].append(phylop_score)
+
+    for conservation_id, species_id, nucleotide in nucleotides:
+        gene_name, column = locations[conservation_id]
+        gene_columns = columns[gene_name]
+
+        # positions a species has no row for are left as -, an empty letter in the file comes back from the CHAR(1) column as a blank and is kept
+        species_nucleotides = gene_columns["nucleotides"].setdefault(species_names[species_id], ["-"] * len(gene_columns["positions"]))
+        species_nucleotides[column] = nucleotide
+
+    matrices = {gene_name: ConservationMatrix(positions = gene_columns["positions"],
+                                              species = list(gene_columns["nucleotides"]),
+                                              nucleotides = {species_name: "".join(letters) for species_name, letters in gene_columns["nucleotides"].items()},
+                                              phastcon_scores = gene_columns["phastcon_scores"],
+                                              phylop_scores = gene_columns["phylop_scores"])
+                for gene_name, gene_columns in columns.items()}
+
+    if only_genes is None:
+        _matrices = matrices
+    else:
+        refreshed = set(only_genes)
+        _matrices = {**{gene_name: matrix for gene_name, matrix in _matrices.items() if gene_name not in refreshed}, **matrices}
+
+# The whole alignment for a gene, every species' nucleotides plus the scores in one response instead of one histogram_data call per species
+@router.get("/matrix", response_model=ConservationMatrix)
+async def get_matrix(gene_name: str) -> ConservationMatrix:
+
+    if gene_name not in _matrices:
+        raise HTTPException(status_code=404, detail="Unable to find scores for given gene")
+
+    return _matrices[gene_name]
+
+# The (phastcon, phylop, nucleotide) rows for a gene and species ordered by position
+async def get_histogram_rows(species_name: str, gene_name: str) -> list[tuple[float, float, str]]:
+
+    matrix = _matrices.get(gene_name)
+
+    # answered from the precomputed matrix whenever it has been built
+    if matrix is not None and species_name in matrix.nucleotides:
+        return [row for row in zip(matrix.phastcon_scores, matrix.phylop_scores, matrix.nucleotides[species_name]) if row[2] != "-"]
+
+    metadata = await get_metadata()
+    gene = metadata.genes.get(gene_name)
+    species = metadata.species.get(species_name)
+
+    if gene is None or species is None:
+        raise HTTPException(status_code=404, detail="Unable to find scores for given gene and species")
 
     async with async_session() as session:
-        stmt = (select(ConservationScores.phastcon_score, ConservationScores.phylop_score, ConservationNucleotides.nucleotide)
+        # scores are cast to floats in postgres so they don't come back as Decimals that have to be converted one by one
+        stmt = (select(cast(ConservationScores.phastcon_score, Float), cast(ConservationScores.phylop_score, Float), ConservationNucleotides.nucleotide)
                 .select_from(ConservationScores)
                 .join(ConservationNucleotides)
-                .join(Genes)
-                .join(Species).where(Genes.name == gene_name)
-                .where(Species.name == species_name)
-                .order_by(ConservationScores.position))
+                .where(ConservationScores.gene_id == gene.id)
+                .where(ConservationNucleotides.species_id == species.id)
+                .order_by(ConservationScores.position_number))
 
         result = (await session.execute(stmt)).tuples().all()
 
-        if len(result) == 0:
-            raise HTTPException(status_code=404, detail="Unable to find scores for given gene and species")
+    if len(result) == 0:
+        raise HTTPException(status_code=404, detail="Unable to find scores for given gene and species")
+
+    return result
+
+# This gets the scores in a sorted list for creating a histogram for a given species
+@router.get("/histogram_data", response_model=List[HistogramData])
+async def get_histogram_data(species_name: str, gene_name: str) -> List[HistogramData]:
+
+    result = await get_histogram_rows(species_name, gene_name)
         
-        data: list[HistogramData] = []
+    data: list[HistogramData] = []
+
+    for row in result:
+        data.append(HistogramData(nucleotide=row[2], phastcon_score=row[0], phylop_score=row[1]))            
+
+
+    return data
 
-        for row in result:
-            data.append(HistogramData(nucleotide=row[2], phastcon_score=row[0], phylop_score=row[1]))            
+# Same data as histogram_data but as one list per column instead of one object per position
+@router.get("/histogram_columns", response_model=HistogramColumns)
+async def get_histogram_columns(species_name: str, gene_name: str) -> HistogramColumns:
 
+    phastcon_scores, phylop_scores, nucleotides = zip(*(await get_histogram_rows(species_name, gene_name)))
 
-        return data
\ No newline at end of file
+    return HistogramColumns(nucleotides="".join(nucleotides), phastcon_scores=phastcon_scores, phylop_scores=phylop_scores)
\ No newline at end of file
@@ -1,30 +1,24 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException
 from typing import List
-from sqlalchemy import select
-from app.models import Genes
-from app.utils import async_session
+from app.metadata import get_metadata
+from app.request_metrics import MeasuredRoute
+from app import readiness
 
-router = APIRouter(prefix="/genes")
+router = APIRouter(prefix="/genes", route_class=MeasuredRoute, dependencies=[Depends(readiness.requires(*readiness.REQUIRED_DATASETS))])
 
 @router.get("/names", response_model=List[str])
 async def get_names() -> List[str]:
     
-    async with async_session() as session:
-        stmt = select(Genes.name)
-        result = (await session.execute(stmt)).fetchall()
+    metadata = await get_metadata()
 
-
-        return [row.name for row in result]
+    return list(metadata.genes)
 
 @router.get("/id", response_model=int)
 async def get_id(name: str) -> int:
 
-    async with async_session() as session:
-
-        stmt = select(Genes.id).where(Genes.name == name)
-        result = (await session.execute(stmt)).scalar() # We should never get more than one row from this query
+    gene = (await get_metadata()).genes.get(name)
 
-        if result is not None:
-            return result
-        else:
-            raise HTTPException(status_code=404, detail="Unable to find gene name")
\ No newline at end of file
+    if gene is not None:
+        return gene.id
+    else:
+        raise HTTPException(status_code=404, detail="Unable to find gene name")
\ No newline at end of file
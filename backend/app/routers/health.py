@@ -0,0 +1,70 @@
+from datetime import datetime
+from typing import Optional
+from fastapi import APIRouter, Response
+from pydantic import BaseModel, Field
+from app.utils import async_engine, pool_metrics
+from app.request_metrics import MeasuredRoute
+from app import readiness
+
+class PoolStatus(BaseModel):
+    size: int = Field(..., description="number of connections the pool keeps open")
+    checked_out: int = Field(..., description="connections currently in use")
+    checked_in: int = Field(..., description="idle connections in the pool")
+    overflow: int = Field(..., description="connections opened past the pool size, negative while the pool isn't full yet")
+    checkouts: int = Field(..., description="connections handed out since startup")
+    connects: int = Field(..., description="new database connections opened since startup")
+    timeouts: int = Field(..., description="checkouts that gave up waiting for a connection")
+    wait_seconds_total: float = Field(..., description="time spent waiting for connections since startup")
+    wait_seconds_max: float = Field(..., description="longest single wait for a connection")
+
+class DatasetStatus(BaseModel):
+    state: str = Field(..., description="ready, reloading, building (loaded but not served by this worker yet), waiting, loading, failed, missing or starting")
+    since: Optional[datetime] = Field(None, description="when the loader got to this state")
+    error: Optional[str] = Field(None, description="why loading it failed")
+
+class GeneStatus(BaseModel):
+    ready: bool = Field(..., description="whether everything the browser shows for this gene can be served")
+    waiting_for: dict[str, DatasetStatus] = Field(..., description="datasets of this gene that requests still get a 503 for")
+
+class Readiness(BaseModel):
+    ready: bool = Field(..., description="whether every table and every gene in genes is ready, the response is a 503 until they are")
+    tables: dict[str, DatasetStatus] = Field(..., description="state of every table in this worker")
+    genes: dict[str, GeneStatus] = Field(..., description="state of every gene, or only of gene_name if it is given")
+
+router = APIRouter(prefix="/health", route_class=MeasuredRoute)
+
+def dataset_status(state: readiness.DatasetState) -> DatasetStatus:
+    return DatasetStatus(state = state.state, since = state.since, error = state.error)
+
+# Readiness probe for this worker, it answers with 503 until everything has been loaded and built so a new instance only
+# gets traffic once it can serve all of it, while the per gene states show what is already usable while serving
+@router.get("/ready", response_model=Readiness)
+async def get_readiness(response: Response, gene_name: Optional[str] = None) -> Readiness:
+
+    tables = {name: dataset_status(readiness.dataset_state(name)) for name in readiness.table_names()}
+
+    genes = {}
+    for name in ([gene_name] if gene_name is not None else await readiness.gene_names()):
+        waiting = readiness.waiting_for(readiness.gene_datasets(name))
+        genes[name] = GeneStatus(ready = not waiting, waiting_for = {dataset: dataset_status(state) for dataset, state in waiting.items()})
+
+    ready = not readiness.waiting_for(readiness.table_names()) and all(gene.ready for gene in genes.values())
+
+    if not ready:
+        response.status_code = 503
+
+    return Readiness(ready = ready, tables = tables, genes = genes)
+
+@router.get("/pool", response_model=PoolStatus)
+async def get_pool_status() -> PoolStatus:
+    pool = async_engine.pool
+
+    return PoolStatus(size = pool.size(),
+                      checked_out = pool.checkedout(),
+                      checked_in = pool.checkedin(),
+                      overflow = pool.overflow(),
+                      checkouts = pool_metrics.checkouts,
+                      connects = pool_metrics.connects,
+                      timeouts = pool_metrics.timeouts,
+                      wait_seconds_total = pool_metrics.wait_seconds_total,
+                      wait_seconds_max = pool_metrics.wait_seconds_max)
\ No newline at end of file
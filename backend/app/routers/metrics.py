@@ -0,0 +1,11 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from app import request_metrics
+from app.request_metrics import MeasuredRoute
+
+router = APIRouter(route_class=MeasuredRoute)
+
+# Prometheus scrape target, see app/request_metrics.py
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> PlainTextResponse:
+    return PlainTextResponse(request_metrics.render(), media_type=request_metrics.CONTENT_TYPE)
\ No newline at end of file
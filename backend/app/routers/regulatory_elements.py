@@ -1,11 +1,16 @@
 import asyncio
-from fastapi import APIRouter
+import math
+from typing import Optional, Union
+from fastapi import APIRouter, Depends, HTTPException, Response
 from pydantic import BaseModel, Field
-from sqlalchemy import or_, select
+from sqlalchemy import func, literal_column, or_, select
 from app.models import *
 from app.utils import async_session
 from fastapi import APIRouter
 from app.routers import regulatory_sequences
+from app import interval_index, packed, readiness, tiles
+from app.metadata import get_metadata
+from app.request_metrics import MeasuredRoute
 
 class Element(BaseModel):
     type: str = Field(..., description="string representing what the element is")
@@ -20,22 +25,42 @@ class Segment(BaseModel):
     start: int = Field(..., description="start of this element")
     end: int = Field(..., description="end of this element")
 
+class BinnedTrack(BaseModel):
+    start: int = Field(..., description="start of the binned window")
+    end: int = Field(..., description="end of the binned window")
+    bin_width: float = Field(..., description="number of bases covered by each bin")
+    types: list[str] = Field(..., description="the category covering the most of each bin or none if nothing is in it")
+    counts: list[int] = Field(..., description="number of elements overlapping each bin")
+
 class VariantsDict(BaseModel):
     variants: dict[str, list[Element]] = Field(..., description="dictionary mapping variant types to a list of positions in the given gene/species combo where those variants are")
 
-router = APIRouter(prefix="/elements")    
+router = APIRouter(prefix="/elements", route_class=MeasuredRoute, dependencies=[Depends(readiness.requires(*readiness.REQUIRED_DATASETS, *readiness.ELEMENT_DATASETS))])    
 
 NORMAL_GAP = "none"
 
+# upper limit for the number of bins a mapped request can ask for, well past the width of any screen
+MAX_BINS = 10000
+
+# ids of the regulatory sequences of every species for this gene
+async def gene_sequence_ids(gene_name: str) -> list[int]:
+    return [sequence.id for sequence in (await get_metadata()).gene_sequences(gene_name)]
+
+# id of the regulatory sequence for this gene and species or None if there isn't one
+async def sequence_id(gene_name: str, species_name: str) -> Optional[int]:
+    sequence = (await get_metadata()).sequences.get((gene_name, species_name))
+
+    return sequence.id if sequence is not None else None
+
+# every category is listed once in alphabetical order, which is the order the frontend shows them in
 @router.get("/all_TFBS", response_model=list[str])
 async def get_all_TFBS(gene_name: str) -> list[str]:
     async with async_session() as session:
 
         stmt = (select(TranscriptionFactorBindingSites.category)
-                .join(RegulatorySequences)
-                .join(Genes)
-                .where(Genes.name == gene_name)
-                .distinct())
+                .where(TranscriptionFactorBindingSites.regulatory_sequence_id.in_(await gene_sequence_ids(gene_name)))
+                .distinct()
+                .order_by(TranscriptionFactorBindingSites.category))
         
         result = (await session.execute(stmt)).scalars().all()
 
@@ -46,10 +71,9 @@ async def get_all_variants(gene_name: str) -> list[str]:
     async with async_session() as session:
 
         stmt = (select(Variants.category)
-                .join(RegulatorySequences)
-                .join(Genes)
-                .where(Genes.name == gene_name)
-                .distinct())
+                .where(Variants.regulatory_sequence_id.in_(await gene_sequence_ids(gene_name)))
+                .distinct()
+                .order_by(Variants.category))
         
         result = (await session.execute(stmt)).scalars().all()
 
@@ -58,45 +82,53 @@ async def get_all_variants(gene_name: str) -> list[str]:
 # returns a dictionary mapping the given variants list to a list of all of the locations where those variants appear in the given gene
 @router.post("/variants_dict", response_model=VariantsDict)
 async def get_variants_dict(gene_name: str, species_name: str, variants_list: list[str]) -> VariantsDict:
-    async with async_session() as session:
-        
-        variants_dict: dict[str, list[Element]] = {}
+    index = interval_index.get_index(Variants, gene_name, species_name)
+
+    # Every requested category is fetched together, from the in memory index when it is built and otherwise with one query
+    if index is not None:
+        wanted = set(variants_list)
+        rows = [row for row in index.rows if row[0] in wanted]
+    else:
+        regulatory_sequence_id = await sequence_id(gene_name, species_name)
 
-        for variant_name in variants_list:
+        async with async_session() as session:
             stmt = (select(Variants.category, Variants.start, Variants.end, Variants.chromosome)
-                .join(RegulatorySequences)
-                .join(Genes)
-                .join(Species)
-                .where(Genes.name == gene_name)
-                .where(Species.name == species_name)
-                .where(Variants.category == variant_name)
+                .where(Variants.regulatory_sequence_id == regulatory_sequence_id)
+                .where(Variants.category.in_(variants_list))
                 .order_by(Variants.start))
-        
-            result = (await session.execute(stmt)).tuples().all()
 
-            if variant_name not in variants_dict:
-                variants_dict[variant_name] = []
-            for item in result:
-                variants_dict[variant_name].append(Element(type=item[0], start=item[1], end=item[2], chromosome=item[3]))
+            rows = (await session.execute(stmt)).tuples().all()
 
-            if len(variants_dict[variant_name]) == 0:
-                del variants_dict[variant_name]
-        
+    # keys are added in the order they were asked for, both sources are sorted by start so every list stays in order
+    variants_dict: dict[str, list[Element]] = {variant_name: [] for variant_name in variants_list}
 
-    return VariantsDict(variants=variants_dict)
+    for row in rows:
+        variants_dict[row[0]].append(Element(type=row[0], start=row[1], end=row[2], chromosome=row[3]))
+
+    return VariantsDict(variants={variant_name: elements for variant_name, elements in variants_dict.items() if elements})
+
+# Matches the expression of the gist indexes created in app/migrations.py, anything the overlap check below accepts
+# also overlaps this range so it can be used to narrow the rows down with the index first
+def element_range(model: type):
+    return func.int8range(model.start, model.end, literal_column("'[]'"))
 
 async def get_elements(model: type, gene_name: str, species_name: str, model_types: list[str], start: int, end: int) -> list[Element]:
+    index = interval_index.get_index(model, gene_name, species_name)
+
+    # Once the in memory indexes are built overlap queries never have to go to the database
+    if index is not None:
+        return [Element(type = row[0], start = row[1], end = row[2], chromosome = row[3]) for row in index.overlapping(start, end, set(model_types))]
+
+    regulatory_sequence_id = await sequence_id(gene_name, species_name)
+
     async with async_session() as session:
 
         model_list: list[Element] = []
 
 
         stmt = (select(model.category, model.start, model.end, model.chromosome)
-                .join(RegulatorySequences)
-                .join(Genes)
-                .join(Species)
-                .where(Genes.name == gene_name)
-                .where(Species.name == species_name)
+                .where(model.regulatory_sequence_id == regulatory_sequence_id)
+                .where(element_range(model).op("&&")(func.int8range(min(start, end), max(start, end), literal_column("'[]'"))))
                 .where(or_(((model.start >= start) & (model.start < end)), ((model.end <= end) & (model.end > start)), ((model.start <= start) & (model.end >= end))))
                 .where(model.category.in_(model_types))
                 .order_by(model.start))
@@ -113,64 +145,130 @@ async def get_elements(model: type, gene_name: str, species_name: str, model_typ
 
 # Returns a list of all variant locations within the given parameters
 @router.post("/filtered_variants", response_model=list[Element])
-async def get_filtered_variants(gene_name: str, species_name: str, variants_types: list[str], start: int, end: int) -> list[Element]:
-    return await get_elements(Variants, gene_name, species_name, variants_types, start, end)
+async def get_filtered_variants(gene_name: str, species_name: str, variants_types: list[str], start: int, end: int, format: packed.Format = "json") -> Union[list[Element], Response]:
+    element_list = await get_elements(Variants, gene_name, species_name, variants_types, start, end)
+
+    return packed.response(packed.elements(element_list)) if format == "packed" else element_list
 
 # Returns a list of all enahncers and promoter locations within the given parameters
 @router.post("/filtered_Enh_Prom", response_model=list[Element])
-async def get_filtered_Enh_Prom(gene_name: str, species_name: str, element_types: list[str], start: int, end: int) -> list[Element]:
-    return await get_elements(EnhancersPromoters, gene_name, species_name, element_types, start, end)
+async def get_filtered_Enh_Prom(gene_name: str, species_name: str, element_types: list[str], start: int, end: int, format: packed.Format = "json") -> Union[list[Element], Response]:
+    element_list = await get_elements(EnhancersPromoters, gene_name, species_name, element_types, start, end)
+
+    return packed.response(packed.elements(element_list)) if format == "packed" else element_list
     
 # Returns a list of all transcription factor binding site locations within the given parameters
 @router.post("/filtered_TFBS", response_model=list[Element])
-async def get_filtered_TFBS(gene_name: str, species_name: str, element_types: list[str], start: int, end: int) -> list[Element]:
-    return await get_elements(TranscriptionFactorBindingSites, gene_name, species_name, element_types, start, end)
+async def get_filtered_TFBS(gene_name: str, species_name: str, element_types: list[str], start: int, end: int, format: packed.Format = "json") -> Union[list[Element], Response]:
+    element_list = await get_elements(TranscriptionFactorBindingSites, gene_name, species_name, element_types, start, end)
+
+    return packed.response(packed.elements(element_list)) if format == "packed" else element_list
     
-@router.post("/mapped_TFBS", response_model=list[Segment])
-async def get_mapped_TFBS(gene_name: str, species_name: str, element_types: list[str], start: int, end: int) -> list[Segment]:
+@router.post("/mapped_TFBS", response_model=Union[list[Segment], BinnedTrack])
+async def get_mapped_TFBS(gene_name: str, species_name: str, element_types: list[str], start: int, end: int, bins: Optional[int] = None, format: packed.Format = "json") -> Union[list[Segment], BinnedTrack, Response]:
+    track = await get_mapped_elements(TranscriptionFactorBindingSites, gene_name, species_name, element_types, start, end, bins)
 
-    element_list, offsets = await asyncio.gather(
-        get_filtered_TFBS(gene_name, species_name, element_types, start, end),
-        regulatory_sequences.get_sequence_offsets(gene_name),
-    )
+    return packed.response(packed.track(track)) if format == "packed" else track
 
-    sequence_start = start + offsets.offsets[species_name]
-    sequence_end = end + offsets.offsets[species_name]
+@router.post("/mapped_Enh_Prom", response_model=Union[list[Segment], BinnedTrack])
+async def get_mapped_Enh_Prom(gene_name: str, species_name: str, element_types: list[str], start: int, end: int, bins: Optional[int] = None, format: packed.Format = "json") -> Union[list[Segment], BinnedTrack, Response]:
+    track = await get_mapped_elements(EnhancersPromoters, gene_name, species_name, element_types, start, end, bins)
 
-    color_map = await populate_color_map(sequence_start, sequence_end, element_list, offsets.offsets[species_name])
+    return packed.response(packed.track(track)) if format == "packed" else track
 
-    return color_map
+@router.post("/mapped_Variants", response_model=Union[list[Segment], BinnedTrack])
+async def get_mapped_Variants(gene_name: str, species_name: str, variant_types: list[str], start: int, end: int, bins: Optional[int] = None, format: packed.Format = "json") -> Union[list[Segment], BinnedTrack, Response]:
+    track = await get_mapped_elements(Variants, gene_name, species_name, variant_types, start, end, bins)
 
-@router.post("/mapped_Enh_Prom", response_model=list[Segment])
-async def get_mapped_Enh_Prom(gene_name: str, species_name: str, element_types: list[str], start: int, end: int) -> list[Segment]:
+    return packed.response(packed.track(track)) if format == "packed" else track
 
-    element_list, offsets = await asyncio.gather(
-        get_filtered_Enh_Prom(gene_name, species_name, element_types, start, end),
-        regulatory_sequences.get_sequence_offsets(gene_name),
-    )
+# Segments for every element when bins isn't given, otherwise a fixed number of pre aggregated bins so the response
+# size only depends on how many pixels the frontend is going to draw and not on how many elements are in the window
+# offsets can be passed in by callers mapping several tracks of the same gene so they are only looked up once
+async def get_mapped_elements(model: type, gene_name: str, species_name: str, model_types: list[str], start: int, end: int, bins: Optional[int],
+                              offsets: Optional[regulatory_sequences.Offsets] = None) -> Union[list[Segment], BinnedTrack]:
 
-    sequence_start = start + offsets.offsets[species_name]
-    sequence_end = end + offsets.offsets[species_name]
+    if bins is not None:
+        if bins < 1 or bins > MAX_BINS:
+            raise HTTPException(status_code=400, detail=f"bins has to be between 1 and {MAX_BINS}")
 
-    color_map = await populate_color_map(sequence_start, sequence_end, element_list, offsets.offsets[species_name])
+        if end <= start:
+            raise HTTPException(status_code=400, detail="Invalid coordinates")
 
-    return color_map
+        # the precomputed tiles give the same bins as bin_elements without looking at any elements
+        track_tiles = tiles.get_tiles(model, gene_name, species_name)
 
-@router.post("/mapped_Variants", response_model=list[Segment])
-async def get_mapped_Variants(gene_name: str, species_name: str, variant_types: list[str], start: int, end: int) -> list[Segment]:
+        if track_tiles is not None:
+            bin_width, types, counts = track_tiles.binned(start, end, bins, set(model_types), NORMAL_GAP)
+            return BinnedTrack(start = start, end = end, bin_width = bin_width, types = types, counts = counts)
 
-    element_list, offsets = await asyncio.gather(
-        get_filtered_variants(gene_name, species_name, variant_types, start, end),
-        regulatory_sequences.get_sequence_offsets(gene_name),
-    )
+    if offsets is None:
+        element_list, offsets = await asyncio.gather(
+            get_elements(model, gene_name, species_name, model_types, start, end),
+            regulatory_sequences.get_sequence_offsets(gene_name),
+        )
+    else:
+        element_list = await get_elements(model, gene_name, species_name, model_types, start, end)
 
-    sequence_start = start + offsets.offsets[species_name]
-    sequence_end = end + offsets.offsets[species_name]
+    if bins is not None:
+        return bin_elements(start, end, element_list, bins)
 
-    color_map = await populate_color_map(sequence_start, sequence_end, element_list, offsets.offsets[species_name])
+    offset = offsets.offsets[species_name]
+
+    return await populate_color_map(start + offset, end + offset, element_list, offset)
+
+# Splits [start, end) into equal bins and gives every bin the category covering most of it and how many elements touch it
+def bin_elements(start: int, end: int, element_list: list[Element], bins: int) -> BinnedTrack:
+
+    bin_width = (end - start) / bins
+    edges = tiles.bin_edges(start, end, bins)
+
+    coverage: list[Optional[dict[str, float]]] = [None] * bins
+    counts = [0] * bins
+
+    for element in element_list:
+
+        # Variants have start and end the same if one nucleotide so they still cover one base
+        element_start = max(element.start, start)
+        element_end = min(max(element.end, element.start + 1), end)
+
+        if element_end <= element_start:
+            continue
+
+        # a bin either side as dividing can round to the wrong bin, those just don't cover anything
+        first_bin = max(int((element_start - start) / bin_width) - 1, 0)
+        last_bin = min(math.ceil((element_end - start) / bin_width) + 1, bins)
+
+        for i in range(first_bin, last_bin):
+            bin_start = edges[i]
+            bin_end = edges[i + 1]
+
+            covered = min(element_end, bin_end) - max(element_start, bin_start)
+
+            if covered <= 0:
+                continue
+
+            if coverage[i] is None:
+                coverage[i] = {}
+
+            coverage[i][element.type] = coverage[i].get(element.type, 0) + covered
+            counts[i] += 1
+
+    types = [NORMAL_GAP if bin_coverage is None else dominant(bin_coverage) for bin_coverage in coverage]
+
+    return BinnedTrack(start = start, end = end, bin_width = bin_width, types = types, counts = counts)
+
+# The category covering the most of a bin. Coverages that only differ by rounding are a tie and go to the category that
+# was seen first, the same rule app/tiles.py uses, so both give the same answer.
+def dominant(bin_coverage: dict[str, float]) -> str:
+    best = None
+
+    for category, covered in bin_coverage.items():
+        if best is None or covered > bin_coverage[best] + tiles.TIE:
+            best = category
+
+    return best
 
-    return color_map
-    
 # From the parameters generates a list of segments where the widths add up to 100 that can be given to the frontend to display
 async def populate_color_map(sequence_start: int, sequence_end: int, element_list: list[Element], offset: int) -> list[Segment]:
 
@@ -216,26 +314,5 @@ async def populate_color_map(sequence_start: int, sequence_end: int, element_lis
     # add any remaing allignment space
     if (prev_index < sequence_end) and (curr_width < 100):
         color_segment_list.append(Segment(type = NORMAL_GAP, width=100-curr_width, start = (prev_index - offset), end = (sequence_end - offset), chromosome=(0)))
-    
-
-    # Merge segments that are below the threshold
-    # length = len(color_segment_list)
-    # i = 0
-    # while i < length:
-        
-    #     if color_segment_list[i].width < THRESHOLD:
-    #         if i > 0:
-    #             color_segment_list[i - 1].width += color_segment_list[i].width
-    #             del color_segment_list[i]
-    #             i -= 1
-    #             length -= 1
-    #         else:
-    #             color_segment_list[i + 1].width += color_segment_list[i].width
-    #             del color_segment_list[i]
-    #             i -= 1
-    #             length -= 1
-
-    #     i += 1
-
 
     return color_segment_list
\ No newline at end of file
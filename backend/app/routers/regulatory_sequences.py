@@ -1,14 +1,19 @@
-import asyncio
-from typing import Dict, List
-from fastapi import APIRouter, HTTPException
+import json
+import re
+from typing import AsyncIterator, Dict, List, Literal, Optional, Union
+from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from sqlalchemy import select
-from app.models import RegulatorySequences, Species, Genes
+from sqlalchemy import func, select
+from app.models import RegulatorySequences
 from app.utils import async_session
+from app import packed, readiness, sequence_store
+from app.metadata import SequenceInfo, get_metadata
 
 from fastapi import APIRouter
 
 from app.routers import species
+from app.request_metrics import MeasuredRoute
 
 class GeonomicCoordinate(BaseModel):
     start: int = Field(..., description="Start position of the sequence range")
@@ -22,162 +27,224 @@ class NucleotideSegment(BaseModel):
     type: str = Field(..., description="single char representing a nucelotide letter")
     width: float = Field(..., ge=0, le=100, description="Width percentage (0-100)")
 
-router = APIRouter(prefix="/sequences")
+class NucleotideRuns(BaseModel):
+    start: int = Field(..., description="Start position of the sequence range")
+    end: int = Field(..., description="End position of the sequence range")
+    bases: str = Field(..., description="The letter of every run")
+    lengths: list[int] = Field(..., description="How many bases long every run is")
+
+class BaseComposition(BaseModel):
+    start: int = Field(..., description="Start position of the sequence range")
+    end: int = Field(..., description="End position of the sequence range")
+    bin_width: float = Field(..., description="Number of bases in every bin")
+    counts: dict[str, list[int]] = Field(..., description="Dictionary mapping A, C, G, T and N to how many times they appear in every bin")
+
+router = APIRouter(prefix="/sequences", route_class=MeasuredRoute, dependencies=[Depends(readiness.requires(*readiness.REQUIRED_DATASETS))])
+
+RUN = re.compile(r"(.)\1*")
+
+COMPOSITION_BASES = "ACGTN"
+
+# bases read and sent at a time by /stream, a multiple of FASTA_LINE so every chunk ends on a full line
+FASTA_LINE = 60
+STREAM_CHUNK = FASTA_LINE * 1024
+
+# Looks the gene/species pair up in the metadata registry so none of the queries below need to join Genes and Species
+async def get_sequence_info(gene_name: str, species_name: str, detail: str) -> SequenceInfo:
+    sequence = (await get_metadata()).sequences.get((gene_name, species_name))
+
+    if sequence is None:
+        raise HTTPException(status_code=404, detail=detail)
+
+    return sequence
 
 @router.get("/id", response_model=int)
 async def get_id(species_name: str, gene_name: str) -> int:
 
-    async with async_session() as session:
-        stmt = select(RegulatorySequences.id).join(Genes).join(Species).where(Species.name == species_name).where(Genes.name == gene_name)
-        result = (await session.execute(stmt)).scalar() # We should never get more than one row from this query
+    sequence = await get_sequence_info(gene_name, species_name, "Unable to find sequence")
 
-        if result is not None:
-            return result
-        else:
-            raise HTTPException(status_code=404, detail="Unable to find sequence")
+    return sequence.id
         
 @router.get("/sequence", response_model=str)
-async def get_sequence(gene_name: str, species_name: str) -> str:
+async def get_sequence(gene_name: str, species_name: str, format: packed.Format = "json") -> Union[str, Response]:
+    sequence_file = sequence_store.open_sequence(gene_name, species_name)
+
+    if sequence_file is not None:
+        result = sequence_file.read(0, len(sequence_file))
+        return packed.response(packed.sequence(result)) if format == "packed" else result
+
+    sequence = await get_sequence_info(gene_name, species_name, "Unable to find sequence")
+
     async with async_session() as session:
-        stmt = select(RegulatorySequences.sequence).join(Genes).join(Species).where(Genes.name == gene_name).where(Species.name == species_name)
+        stmt = select(RegulatorySequences.sequence).where(RegulatorySequences.id == sequence.id)
         result = (await session.execute(stmt)).scalar() # There should only be 1 result
 
         if result is not None:
-            return result
+            return packed.response(packed.sequence(result)) if format == "packed" else result
         else:
             raise HTTPException(status_code=404, detail="Unable to find sequence")
     
 # returns the range in [start, end]
 @router.get("/total_range", response_model=tuple[int, int])
 async def get_total_range(gene_name: str, species_name: str) -> tuple[int, int]:
-    async with async_session() as session:
-        stmt = (select(RegulatorySequences.total_start, RegulatorySequences.total_end)
-                .join(Genes)
-                .join(Species)
-                .where(Genes.name == gene_name)
-                .where(Species.name == species_name))
-    
-        result = (await session.execute(stmt)).tuples().first()
 
-        if result is None:
-            raise HTTPException(status_code=404, detail=f"Unable to find range for {gene_name} and {species_name}")
+    sequence = await get_sequence_info(gene_name, species_name, f"Unable to find range for {gene_name} and {species_name}")
 
-    return (result[0], result[1])
+    return (sequence.total_start, sequence.total_end)
 
 @router.get("/range", response_model=str)
-async def get_sequence_range(gene_name: str, species_name: str, start: int, end: int) -> str:
+async def get_sequence_range(gene_name: str, species_name: str, start: int, end: int, format: packed.Format = "json") -> Union[str, Response]:
 
-    range, sequence = await asyncio.gather(
-        get_total_range(gene_name, species_name),
-        get_sequence(gene_name, species_name)
-    )
+    range = await get_total_range(gene_name, species_name)
 
     if range[0] > start or range[1] < end:
         raise HTTPException(status_code=400, detail="Invalid coordinates")
 
-    relative_start = start - range[0]
-    relative_end = end - range[0]
+    sequence_file = sequence_store.open_sequence(gene_name, species_name)
 
-    return sequence[relative_start:relative_end]
+    # Reads come from the memory mapped sequence store when it has been written, otherwise postgres slices the column
+    if sequence_file is not None:
+        result = sequence_file.read(start - range[0], end - range[0])
+        return packed.response(packed.sequence(result)) if format == "packed" else result
+
+    sequence_id = await get_id(species_name, gene_name)
+
+    async with async_session() as session:
+        # The slice is taken by postgres so only the requested bases are sent back instead of the whole sequence
+        stmt = (select(func.substr(RegulatorySequences.sequence, start - range[0] + 1, max(end - start, 0)))
+                .where(RegulatorySequences.id == sequence_id))
+
+        result = (await session.execute(stmt)).scalar()
+
+        if result is None:
+            raise HTTPException(status_code=404, detail=f"Unable to find range for {gene_name} and {species_name}")
+
+    return packed.response(packed.sequence(result)) if format == "packed" else result
         
+# The same range as /range but sent in STREAM_CHUNK sized pieces as plain text or FASTA, so a whole region can be
+# downloaded without the worker holding a copy of it
+@router.get("/stream", response_class=StreamingResponse)
+async def stream_sequence_range(gene_name: str, species_name: str, start: int, end: int, output: Literal["plain", "fasta"] = "plain") -> StreamingResponse:
+
+    # checked before the response starts so bad requests still get a proper status code
+    range = await get_total_range(gene_name, species_name)
+
+    if range[0] > start or range[1] < end:
+        raise HTTPException(status_code=400, detail="Invalid coordinates")
+
+    chunks = sequence_chunks(gene_name, species_name, start - range[0], end - range[0])
+
+    if output == "fasta":
+        assembly = (await get_metadata()).species[species_name].assembly
+        chunks = fasta_lines(f">{gene_name} {species_name} {assembly}:{start}-{end}", chunks)
+
+    return StreamingResponse(chunks, media_type="text/plain")
+
+# Reads [start, end) relative to the start of the sequence one chunk at a time, from the sequence store or with
+# one substring query per chunk when it hasn't been written
+async def sequence_chunks(gene_name: str, species_name: str, start: int, end: int) -> AsyncIterator[str]:
+    sequence_file = sequence_store.open_sequence(gene_name, species_name)
+
+    if sequence_file is not None:
+        for chunk_start in range(start, end, STREAM_CHUNK):
+            yield sequence_file.read(chunk_start, min(chunk_start + STREAM_CHUNK, end))
+        return
+
+    sequence_id = (await get_sequence_info(gene_name, species_name, "Unable to find sequence")).id
+
+    async with async_session() as session:
+        for chunk_start in range(start, end, STREAM_CHUNK):
+            stmt = (select(func.substr(RegulatorySequences.sequence, chunk_start + 1, min(STREAM_CHUNK, end - chunk_start)))
+                    .where(RegulatorySequences.id == sequence_id))
+
+            yield (await session.execute(stmt)).scalar() or ""
+
+async def fasta_lines(header: str, chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    yield header + "\n"
+
+    async for chunk in chunks:
+        yield "".join(chunk[i:i + FASTA_LINE] + "\n" for i in range(0, len(chunk), FASTA_LINE))
+
 @router.get("/allignment_numbers", response_model=dict[str,int])
 async def get_allignment_numbers(gene_name: str) -> dict[str,int]:
-    async with async_session() as session:
-        stmt = select(RegulatorySequences.allignment_num, Species.name).select_from(RegulatorySequences).join(Genes).join(Species).where(Genes.name == gene_name)
-        result = (await session.execute(stmt)).tuples().all()
 
-        return_value: dict[str, int] = {}
+    return_value: dict[str, int] = {}
 
-        for row in result:
-            return_value[row[1]] = row[0]
+    for sequence in (await get_metadata()).gene_sequences(gene_name):
+        return_value[sequence.species_name] = sequence.allignment_num
 
     return return_value
 
 # gets the genomic coordinates for the individual gene
 @router.get("/genomic_coordinate", response_model=GeonomicCoordinate)
 async def get_genomic_coordinate(gene_name: str, species_name: str) -> GeonomicCoordinate:
-    async with async_session() as session:
-        stmt = (select(RegulatorySequences.gene_start, RegulatorySequences.gene_end)
-                .join(Genes)
-                .join(Species)
-                .where(Genes.name == gene_name)
-                .where(Species.name == species_name))
-        
-        result = (await session.execute(stmt)).tuples().first()
 
-        if result is None:
-            raise HTTPException(status_code=404, detail=f"Unable to get gene coordinates for {gene_name} and {species_name}")
+    sequence = await get_sequence_info(gene_name, species_name, f"Unable to get gene coordinates for {gene_name} and {species_name}")
 
-        return GeonomicCoordinate(start = result[0], end = result[1])
+    return GeonomicCoordinate(start = sequence.gene_start, end = sequence.gene_end)
     
 # gets the genomic coordinates for the total sequence
 @router.get("/sequence_coordinate", response_model=GeonomicCoordinate)
 async def get_sequence_coordinate(gene_name: str, species_name: str) -> GeonomicCoordinate:
-    async with async_session() as session:
-        stmt = (select(RegulatorySequences.total_start, RegulatorySequences.total_end)
-                .join(Genes)
-                .join(Species)
-                .where(Genes.name == gene_name)
-                .where(Species.name == species_name))
-        
-        result = (await session.execute(stmt)).tuples().first()
 
-        if result is None:
-            raise HTTPException(status_code=404, detail=f"Unable to get sequence coordinates for {gene_name} and {species_name}")
+    sequence = await get_sequence_info(gene_name, species_name, f"Unable to get sequence coordinates for {gene_name} and {species_name}")
 
-        return GeonomicCoordinate(start = result[0], end = result[1])
+    return GeonomicCoordinate(start = sequence.total_start, end = sequence.total_end)
 
 # gets the sequence coordinates for every species in a dictionary with species as the key
 @router.get("/all_sequence_coordinates", response_model=dict[str, GeonomicCoordinate])
 async def get_all_sequence_coordinates(gene_name: str) -> dict[str, GeonomicCoordinate]:
-    async with async_session() as session:
-
-        stmt = (select(Species.name, RegulatorySequences.total_start, RegulatorySequences.total_end)
-                .select_from(RegulatorySequences)
-                .join(Genes)
-                .join(Species)
-                .where(Genes.name == gene_name))
-        
-        result = (await session.execute(stmt)).tuples().all()
         
-        return_value: dict[str, GeonomicCoordinate] = {}
+    return_value: dict[str, GeonomicCoordinate] = {}
 
-        for row in result:
-            curr_geo_coord = GeonomicCoordinate(start = row[1], end = row[2])
-            return_value[row[0]] = curr_geo_coord
+    for sequence in (await get_metadata()).gene_sequences(gene_name):
+        return_value[sequence.species_name] = GeonomicCoordinate(start = sequence.total_start, end = sequence.total_end)
 
-        return return_value
+    return return_value
     
 # gets the gene coordinates for every species in a dictionary with species as the key
 @router.get("/all_geonomic_coordinates", response_model=dict[str, GeonomicCoordinate])
 async def get_all_geonomic_coordinates(gene_name: str) -> dict[str, GeonomicCoordinate]:
-    async with async_session() as session:
-
-        stmt = (select(Species.name, RegulatorySequences.gene_start, RegulatorySequences.gene_end)
-                .select_from(RegulatorySequences)
-                .join(Genes)
-                .join(Species)
-                .where(Genes.name == gene_name))
         
-        result = (await session.execute(stmt)).tuples().all()
-        
-        return_value: dict[str, GeonomicCoordinate] = {}
+    return_value: dict[str, GeonomicCoordinate] = {}
 
-        for row in result:
-            curr_geo_coord = GeonomicCoordinate(start = row[1], end = row[2])
-            return_value[row[0]] = curr_geo_coord
+    for sequence in (await get_metadata()).gene_sequences(gene_name):
+        return_value[sequence.species_name] = GeonomicCoordinate(start = sequence.gene_start, end = sequence.gene_end)
 
-        return return_value
+    return return_value
     
+# gene name -> offsets for every species of that gene, these only change when the tables are reloaded
+_offsets_cache: dict[str, Offsets] = {}
+
+# Recomputes the offsets of every gene from the metadata registry and replaces the cache, has to be called again whenever the tables are reloaded
+async def refresh_offsets() -> None:
+    global _offsets_cache
+
+    metadata = await get_metadata()
+
+    new_cache: dict[str, Offsets] = {}
+
+    for gene_name in metadata.genes:
+        new_cache[gene_name] = compute_offsets(await get_allignment_numbers(gene_name), await get_all_sequence_coordinates(gene_name))
+
+    _offsets_cache = new_cache
+
 # This is going to return a list of all species mapped to the offsets of their sequences from zero
 @router.get("/sequence_offsets", response_model=Offsets)
 async def get_sequence_offsets(gene_name: str) -> Offsets:
 
+    if gene_name in _offsets_cache:
+        return _offsets_cache[gene_name]
+
     allignment_num = await get_allignment_numbers(gene_name)
 
 
     geo_coords = await get_all_sequence_coordinates(gene_name)
 
+    return compute_offsets(allignment_num, geo_coords)
+
+def compute_offsets(allignment_num: dict[str, int], geo_coords: dict[str, GeonomicCoordinate]) -> Offsets:
+
     offsets: dict[str, int] = {}
 
     largest_negative_start_coordinate = 0
@@ -224,26 +291,67 @@ async def get_sequence_offsets(gene_name: str) -> Offsets:
 #     return (min, max)
 
 @router.get("/mapped_nucleotides", response_model=list[NucleotideSegment])
-async def get_mapped_nucleotides(gene_name: str, species_name: str, start: int, end: int, show_letters: bool) -> list[NucleotideSegment]:
+async def get_mapped_nucleotides(gene_name: str, species_name: str, start: int, end: int, show_letters: bool, format: packed.Format = "json") -> Union[list[NucleotideSegment], Response]:
 
     sequence = await get_sequence_range(gene_name, species_name, start, end)
 
-    nucleotide_bar: list[NucleotideSegment] = []
+    # Every base is its own segment when the letters are shown, the response is made straight from the sequence so a
+    # large window doesn't turn into a segment object per base
+    if show_letters:
+        if format == "packed":
+            return packed.response(packed.nucleotide_letters(sequence))
 
-    for i in range(len(sequence)):
-
-        if i > 0 and not show_letters:
-            if nucleotide_bar[-1].type == sequence[i]:
-                nucleotide_bar[-1].width += 1
-            else:
-                nucleotide_bar.append(NucleotideSegment(type=sequence[i], width=1))
-        else:
-            nucleotide_bar.append(NucleotideSegment(type=sequence[i], width=1))
+        return Response(content=letter_segments_json(sequence), media_type="application/json")
 
+    runs = nucleotide_runs(sequence)
 
     # Convert widths to percentages
     total_width = len(sequence)
-    for segment in nucleotide_bar:
-        segment.width = (segment.width / total_width) * 100
 
-    return nucleotide_bar
\ No newline at end of file
+    segments = [NucleotideSegment(type=base, width=(length / total_width) * 100) for base, length in runs]
+
+    return packed.response(packed.nucleotide_segments(segments)) if format == "packed" else segments
+
+# The JSON list of NucleotideSegment with one segment per base, every base is replaced by its whole segment in one
+# translate. Written the way FastAPI would write the models.
+def letter_segments_json(sequence: str) -> str:
+    if not sequence:
+        return "[]"
+
+    width = json.dumps((1 / len(sequence)) * 100)
+    segments = {ord(base): f'{{"type":{json.dumps(base)},"width":{width}}},' for base in set(sequence)}
+
+    return "[" + sequence.translate(segments)[:-1] + "]"
+
+# splits the sequence into runs of the same letter, the scanning is done by the regex engine instead of a python loop
+def nucleotide_runs(sequence: str) -> list[tuple[str, int]]:
+    return [(match.group(1), match.end() - match.start()) for match in RUN.finditer(sequence)]
+
+# Compact nucleotide bar, run length encoded when the window fits in the pixel budget and
+# otherwise the number of each base in every bin
+@router.get("/nucleotide_track", response_model=Union[NucleotideRuns, BaseComposition])
+async def get_nucleotide_track(gene_name: str, species_name: str, start: int, end: int, bins: Optional[int] = None) -> Union[NucleotideRuns, BaseComposition]:
+
+    if bins is not None and bins < 1:
+        raise HTTPException(status_code=400, detail="bins has to be at least 1")
+
+    sequence = await get_sequence_range(gene_name, species_name, start, end)
+
+    if bins is None or len(sequence) <= bins:
+        runs = nucleotide_runs(sequence)
+
+        return NucleotideRuns(start = start, end = end, bases = "".join(base for base, _ in runs), lengths = [length for _, length in runs])
+
+    return base_composition(start, end, sequence.upper(), bins)
+
+def base_composition(start: int, end: int, sequence: str, bins: int) -> BaseComposition:
+
+    bin_width = len(sequence) / bins
+    bounds = [int(i * bin_width) for i in range(bins + 1)]
+
+    counts: dict[str, list[int]] = {}
+
+    for base in COMPOSITION_BASES:
+        counts[base] = [sequence.count(base, bounds[i], bounds[i + 1]) for i in range(bins)]
+
+    return BaseComposition(start = start, end = end, bin_width = bin_width, counts = counts)
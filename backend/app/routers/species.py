@@ -1,36 +1,31 @@
 from typing import List
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
-from sqlalchemy import select
-from app.models import Species
-from app.utils import async_session
+from app.metadata import get_metadata
+from app.request_metrics import MeasuredRoute
+from app import readiness
 
 from fastapi import APIRouter
 
 
-router = APIRouter(prefix="/species")
+router = APIRouter(prefix="/species", route_class=MeasuredRoute, dependencies=[Depends(readiness.requires(*readiness.REQUIRED_DATASETS))])
 
 @router.get("/names", response_model=List[str])
 async def get_names() -> List[str]:
     
-    async with async_session() as session:
-        stmt = select(Species.name)
-        result = (await session.execute(stmt)).fetchall()
+    metadata = await get_metadata()
 
-
-        return [row.name for row in result]
+    return list(metadata.species)
 
 @router.get("/id", response_model=int)
 async def get_id(name: str) -> int:
 
-    async with async_session() as session:    
-        stmt = select(Species.id).where(Species.name == name)
-        result = (await session.execute(stmt)).scalar() # We should never get more than one row from this query
+    species = (await get_metadata()).species.get(name)
 
-        if result is not None:
-            return result
-        else:
-            raise HTTPException(status_code=404, detail="Unable to find species name")
+    if species is not None:
+        return species.id
+    else:
+        raise HTTPException(status_code=404, detail="Unable to find species name")
         
 class Assembly(BaseModel):
     assembly: str
@@ -38,11 +33,9 @@ class Assembly(BaseModel):
 @router.get("/assemblies", response_model=Assembly)
 async def get_assemblies(species_name: str) -> Assembly:
 
-    async with async_session() as session:
-        stmt = select(Species.assembly).where(Species.name == species_name)
-        result = (await session.execute(stmt)).scalar()
+    species = (await get_metadata()).species.get(species_name)
 
-        if result is not None:
-            return Assembly(assembly=result)
-        else:
-            raise HTTPException(status_code=404, detail=f"Unable to find assembly for {species_name}")
\ No newline at end of file
+    if species is not None:
+        return Assembly(assembly=species.assembly)
+    else:
+        raise HTTPException(status_code=404, detail=f"Unable to find assembly for {species_name}")
\ No newline at end of file
@@ -0,0 +1,147 @@
+import mmap
+import os
+import re
+import struct
+from bisect import bisect_right
+from typing import Optional
+
+# Regulatory sequences are kept on disk packed at 2 bits per base so they can be memory mapped and sliced
+# without going through the database. One file per gene/species laid out as (all integers little endian):
+#
+#   header       magic b"CRG2BIT\0", version u32, base count u64, N block count u32, mask block count u32
+#   N blocks     (start u64, length u64) for every run of N (or any other non ACGT letter), sorted by start
+#   mask blocks  (start u64, length u64) for every run of lower case (soft masked) bases, sorted by start
+#   bases        ceil(base count / 4) bytes, 4 bases per byte with the first base in the highest 2 bits
+#                using T=0 C=1 A=2 G=3, N runs are stored as T and restored from the N blocks when reading
+
+STORE_DIR = os.environ.get("SEQUENCE_STORE_DIR", "app/store")
+
+MAGIC = b"CRG2BIT\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIQII")
+BLOCK = struct.Struct("<QQ")
+
+BASES = b"TCAG"
+
+# maps every letter to its 2 bit code, anything that isn't ACGT ends up as T and gets covered by an N block
+ENCODE = bytes(BASES.find(bytes([letter]).upper()) if bytes([letter]).upper() in BASES else 0 for letter in range(256))
+
+# maps every packed byte back to the 4 letters it holds
+DECODE = [bytes(BASES[(byte >> shift) & 3] for shift in (6, 4, 2, 0)) for byte in range(256)]
+
+N_RUN = re.compile(rb"[^ACGTacgt]+")
+MASK_RUN = re.compile(rb"[a-z]+")
+
+def sequence_path(gene_name: str, species_name: str) -> str:
+    return os.path.join(STORE_DIR, f"{species_name}-{gene_name}.2bit")
+
+def pack(sequence: bytes) -> bytes:
+    codes = sequence.translate(ENCODE)
+
+    # pad to a multiple of 4 so every byte gets 4 bases
+    codes += bytes(-len(codes) % 4)
+
+    return bytes(a << 6 | b << 4 | c << 2 | d for a, b, c, d in zip(codes[0::4], codes[1::4], codes[2::4], codes[3::4]))
+
+def write_sequence(gene_name: str, species_name: str, sequence: str) -> None:
+    data = sequence.encode("ascii")
+
+    n_blocks = [(match.start(), match.end() - match.start()) for match in N_RUN.finditer(data)]
+    mask_blocks = [(match.start(), match.end() - match.start()) for match in MASK_RUN.finditer(data)]
+
+    os.makedirs(STORE_DIR, exist_ok=True)
+    path = sequence_path(gene_name, species_name)
+
+    # written next to the real file and renamed over it so readers never see a half written file
+    with open(path + ".tmp", "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, len(data), len(n_blocks), len(mask_blocks)))
+        for block in n_blocks:
+            file.write(BLOCK.pack(*block))
+        for block in mask_blocks:
+            file.write(BLOCK.pack(*block))
+        file.write(pack(data))
+
+    os.replace(path + ".tmp", path)
+    _open_files.pop(path, None)
+
+class SequenceFile:
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.length, n_count, mask_count = HEADER.unpack_from(self.map, 0)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} packed sequence file")
+
+        offset = HEADER.size
+        self.n_blocks = [BLOCK.unpack_from(self.map, offset + i * BLOCK.size) for i in range(n_count)]
+        offset += n_count * BLOCK.size
+        self.mask_blocks = [BLOCK.unpack_from(self.map, offset + i * BLOCK.size) for i in range(mask_count)]
+        offset += mask_count * BLOCK.size
+
+        self.bases_offset = offset
+        self.n_starts = [block[0] for block in self.n_blocks]
+        self.mask_starts = [block[0] for block in self.mask_blocks]
+
+    def __len__(self) -> int:
+        return self.length
+
+    # returns the bases in [start, end) using the same clamping as slicing a python string
+    def read(self, start: int, end: int) -> str:
+        start, end, _ = slice(start, end).indices(self.length)
+
+        if end <= start:
+            return ""
+
+        first_byte = start // 4
+        last_byte = (end + 3) // 4
+
+        packed = self.map[self.bases_offset + first_byte:self.bases_offset + last_byte]
+        bases = bytearray(b"".join(map(DECODE.__getitem__, packed)))
+
+        # trim the extra bases that share a byte with the requested range
+        skip = start - first_byte * 4
+        del bases[:skip]
+        del bases[end - start:]
+
+        for block_start, block_end in overlapping(self.n_blocks, self.n_starts, start, end):
+            bases[block_start - start:block_end - start] = b"N" * (block_end - block_start)
+
+        for block_start, block_end in overlapping(self.mask_blocks, self.mask_starts, start, end):
+            bases[block_start - start:block_end - start] = bases[block_start - start:block_end - start].lower()
+
+        return bases.decode("ascii")
+
+# yields the parts of the sorted, non overlapping blocks that fall inside [start, end)
+def overlapping(blocks: list[tuple[int, int]], block_starts: list[int], start: int, end: int):
+    index = max(bisect_right(block_starts, start) - 1, 0)
+
+    while index < len(blocks) and blocks[index][0] < end:
+        block_start, block_length = blocks[index]
+        block_end = block_start + block_length
+
+        if block_end > start:
+            yield max(block_start, start), min(block_end, end)
+
+        index += 1
+
+_open_files: dict[str, SequenceFile] = {}
+
+# Returns the mapped file for this gene and species or None if it hasn't been written
+def open_sequence(gene_name: str, species_name: str) -> Optional[SequenceFile]:
+    path = sequence_path(gene_name, species_name)
+
+    if path not in _open_files:
+        if not os.path.exists(path):
+            return None
+        _open_files[path] = SequenceFile(path)
+
+    return _open_files[path]
+
+# Drops every mapped file so they are mapped again on their next read, processes that didn't replace the files
+# themselves would otherwise keep reading the old ones. Responses still streaming from an old file keep it mapped until
+# they are done with it.
+def reopen_files() -> None:
+    _open_files.clear()
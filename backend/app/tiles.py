@@ -0,0 +1,153 @@
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import Optional
+from app import interval_index
+
+# Precomputed summaries of the element tracks so a binned request never has to look at the elements in its window.
+#
+# For every category the elements' starts and ends are kept sorted with running sums. How much of [0, x) the category
+# covers is then a couple of binary searches (see covered_before), and so is how many elements touch a bin and which
+# element touching it comes first. Every bin of a request is answered from its two edges, so the time depends on the
+# number of bins asked for and not on how many elements are in the window. The answer is the same one bin_elements in
+# app/routers/regulatory_elements.py gives from the elements themselves: both split the window at bin_edges and break
+# ties with the same rule, the coverages only differ by rounding.
+
+# coverages closer than this are the same, bin_elements then picks the category whose first element comes first
+TIE = 1e-6
+
+# The bins [edges[i], edges[i + 1]) a window is split into, shared with bin_elements so both put a base that falls on an
+# edge after rounding in the same bin
+def bin_edges(start: int, end: int, bins: int) -> list[float]:
+    bin_width = (end - start) / bins
+
+    return [start + i * bin_width for i in range(bins)] + [end]
+
+class CategoryTiles:
+
+    # rows is (position in the track's rows, start, end) in the order of the track's rows, which is sorted by start
+    def __init__(self, rows: list[tuple[int, int, int]]):
+        self.order = [row[0] for row in rows]
+        self.starts = [row[1] for row in rows]
+        # Variants have start and end the same if one nucleotide so they still cover one base
+        ends = [max(row[2], row[1] + 1) for row in rows]
+
+        # sums are taken from the first start so they stay small enough for floats to multiply exactly
+        self.origin = self.starts[0] if rows else 0
+        self.start_sums = [0] + list(accumulate(start - self.origin for start in self.starts))
+
+        self.ends = sorted(ends)
+        self.end_sums = [0] + list(accumulate(end - self.origin for end in self.ends))
+
+        # max_ends[i] is the largest end of the first i + 1 elements, it never decreases so it can be binary searched
+        self.max_ends = list(accumulate(ends, max))
+
+        # the stretches covered by at least one element, so bins with none of the category can be skipped
+        self.run_starts: list[int] = []
+        self.run_ends: list[int] = []
+        for start, end in zip(self.starts, ends):
+            if self.run_ends and start <= self.run_ends[-1]:
+                self.run_ends[-1] = max(self.run_ends[-1], end)
+            else:
+                self.run_starts.append(start)
+                self.run_ends.append(end)
+
+    # Bases of [0, x) covered by the elements, counted once per element
+    def covered_before(self, x: float) -> float:
+        started = bisect_left(self.starts, x)
+        ended = bisect_left(self.ends, x)
+
+        # every element that started before x covers x - start of it, minus x - end for those that also ended
+        return (started - ended) * (x - self.origin) - (self.start_sums[started] - self.end_sums[ended])
+
+    # Number of elements touching [bin_start, bin_end)
+    def touching(self, bin_start: float, bin_end: float) -> int:
+        return bisect_left(self.starts, bin_end) - bisect_right(self.ends, bin_start)
+
+    # Bins of the window that may have some of the category in them, every bin if that is fewer than the stretches to go
+    # through. A bin either side is added as the bin of a position can be off by one after rounding.
+    def occupied_bins(self, start: int, end: int, bin_width: float, bins: int):
+        first_run = bisect_right(self.run_ends, start)
+        last_run = bisect_left(self.run_starts, end)
+
+        if last_run - first_run >= bins:
+            return range(bins)
+
+        occupied: list[int] = []
+
+        for run_start, run_end in zip(self.run_starts[first_run:last_run], self.run_ends[first_run:last_run]):
+            first_bin = max(int((run_start - start) / bin_width) - 1, 0 if not occupied else occupied[-1] + 1)
+            last_bin = min(int((run_end - start) / bin_width) + 2, bins)
+            occupied.extend(range(first_bin, last_bin))
+
+        return occupied
+
+    # Position in the track's rows of the first element touching [bin_start, bin_end), None if nothing touches it
+    def first_touching(self, bin_start: float, bin_end: float) -> Optional[int]:
+        # the first element ending after bin_start, nothing after it ends there first and everything before it ends sooner
+        i = bisect_right(self.max_ends, bin_start)
+
+        if i < len(self.starts) and self.starts[i] < bin_end:
+            return self.order[i]
+
+        return None
+
+class TrackTiles:
+
+    def __init__(self, rows: list[interval_index.Row]):
+        grouped: dict[str, list[tuple[int, int, int]]] = {}
+
+        for position, (category, start, end, _) in enumerate(rows):
+            grouped.setdefault(category, []).append((position, start, end))
+
+        self.categories = {category: CategoryTiles(category_rows) for category, category_rows in grouped.items()}
+
+    def size(self) -> int:
+        return sum(len(tiles.starts) for tiles in self.categories.values())
+
+    # Returns (bin width, dominant category per bin, elements per bin) for the window, splitting it into bins the same
+    # way bin_elements does
+    def binned(self, start: int, end: int, bins: int, categories: set[str], gap: str) -> tuple[float, list[str], list[int]]:
+
+        bin_width = (end - start) / bins
+        edges = bin_edges(start, end, bins)
+
+        selected = [(category, self.categories[category]) for category in categories if category in self.categories]
+
+        counts = [0] * bins
+        # bin -> (coverage, position of the first element, category) of the category covering the most of it so far
+        best: list[Optional[tuple[float, int, str]]] = [None] * bins
+
+        for category, tiles in selected:
+            for i in tiles.occupied_bins(start, end, bin_width, bins):
+                bin_start = edges[i]
+                bin_end = edges[i + 1]
+
+                first = tiles.first_touching(bin_start, bin_end)
+
+                if first is None:
+                    continue
+
+                counts[i] += tiles.touching(bin_start, bin_end)
+                covered = tiles.covered_before(bin_end) - tiles.covered_before(bin_start)
+
+                current = best[i]
+                if current is None or covered > current[0] + TIE or (covered > current[0] - TIE and first < current[1]):
+                    best[i] = (covered, first, category)
+
+        types = [gap if bin_best is None else bin_best[2] for bin_best in best]
+
+        return bin_width, types, counts
+
+# (table name, gene name, species name) -> tiles, empty until build_tiles has run
+_tiles: dict[tuple[str, str, str], TrackTiles] = {}
+
+# Builds the tiles of every track from the interval indexes, so it has to run after interval_index.build_indexes
+def build_tiles() -> None:
+    global _tiles
+
+    _tiles = {key: TrackTiles(index.rows) for key, index in interval_index.all_indexes().items()}
+
+    print(f"built tiles for {len(_tiles)} tracks over {sum(tiles.size() for tiles in _tiles.values())} elements")
+
+def get_tiles(model: type, gene_name: str, species_name: str) -> Optional[TrackTiles]:
+    return _tiles.get((model.__tablename__, gene_name, species_name))
@@ -1,12 +1,203 @@
-from sqlalchemy import MetaData
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+import asyncio
+import os
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import AsyncIterator, Iterator, Optional
+from sqlalchemy import MetaData, event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 
 
-DATABASE_URL = "postgresql+psycopg://postgres:postgres@db:5432/DB"
+DATABASE_URL = os.environ.get("DATABASE_URL", "postgresql+psycopg://postgres:postgres@db:5432/DB")
 
-async_engine = create_async_engine(DATABASE_URL, echo=False, future=True)
+# Pool and driver settings, the defaults are the same as sqlalchemy's and psycopg's own
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", -1))
+POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
 
-async_session = async_sessionmaker(async_engine)
+# how many compiled statements sqlalchemy keeps per engine
+QUERY_CACHE_SIZE = int(os.environ.get("DB_QUERY_CACHE_SIZE", 500))
+
+# psycopg prepares a statement after it has run this many times on a connection, "none" turns preparing off which is
+# needed behind pgbouncer in transaction mode
+PREPARE_THRESHOLD = os.environ.get("DB_PREPARE_THRESHOLD", "5")
+
+@dataclass
+class PoolMetrics:
+    checkouts: int = 0
+    connects: int = 0
+    timeouts: int = 0
+    wait_seconds_total: float = 0.0
+    wait_seconds_max: float = 0.0
+
+pool_metrics = PoolMetrics()
+
+# Times every checkout, which includes waiting for a connection to be returned when the pool is exhausted
+class MeasuredPool(AsyncAdaptedQueuePool):
+
+    def _do_get(self):
+        start = perf_counter()
+
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_metrics.timeouts += 1
+            raise
+        finally:
+            waited = perf_counter() - start
+            pool_metrics.wait_seconds_total += waited
+            pool_metrics.wait_seconds_max = max(pool_metrics.wait_seconds_max, waited)
+
+        pool_metrics.checkouts += 1
+
+        return connection
+
+    def _create_connection(self):
+        pool_metrics.connects += 1
+
+        return super()._create_connection()
+
+async_engine = create_async_engine(
+    DATABASE_URL,
+    echo=False,
+    future=True,
+    poolclass=MeasuredPool,
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW,
+    pool_timeout=POOL_TIMEOUT,
+    pool_recycle=POOL_RECYCLE,
+    pool_pre_ping=POOL_PRE_PING,
+    query_cache_size=QUERY_CACHE_SIZE,
+    connect_args={"prepare_threshold": None if PREPARE_THRESHOLD.lower() == "none" else int(PREPARE_THRESHOLD)},
+)
+
+session_factory = async_sessionmaker(async_engine)
+
+# slow request logs show at most this many of a request's statements
+MAX_RECORDED_STATEMENTS = 50
+
+@dataclass
+class QueryStats:
+    count: int = 0
+    seconds: float = 0.0
+    rows: int = 0
+    # (statement, seconds) in the order they ran
+    statements: list[tuple[str, float]] = field(default_factory=list)
+
+_query_stats: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+# Every statement run by the current task, and the tasks it starts, inside the with block is counted in the returned stats
+@contextmanager
+def collect_queries() -> Iterator[QueryStats]:
+    stats = QueryStats()
+    token = _query_stats.set(stats)
+
+    try:
+        yield stats
+    finally:
+        _query_stats.reset(token)
+
+@event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("query_start", []).append(perf_counter())
+
+@event.listens_for(async_engine.sync_engine, "after_cursor_execute")
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    seconds = perf_counter() - connection.info["query_start"].pop()
+    stats = _query_stats.get()
+
+    if stats is None:
+        return
+
+    stats.count += 1
+    stats.seconds += seconds
+    # psycopg gives the number of rows returned for selects and the number of rows changed for everything else
+    stats.rows += max(cursor.rowcount, 0)
+
+    if len(stats.statements) < MAX_RECORDED_STATEMENTS:
+        stats.statements.append((statement, seconds))
+
+# a failed statement never gets to after_cursor_execute so its start time is dropped here. A connection only runs one
+# statement at a time so anything left on its stack is the failed one's, if it got as far as the cursor.
+@event.listens_for(async_engine.sync_engine, "handle_error")
+def handle_error(context):
+    if context.connection is not None and context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
+
+# The session every async_session() block in one HTTP request shares, opened the first time one of them needs it
+class RequestSession:
+
+    def __init__(self):
+        self.session: Optional[AsyncSession] = None
+        self.lock = asyncio.Lock()
+        self.owner: Optional[asyncio.Task] = None
+        self.depth = 0
+
+    # A session can only run one statement at a time so blocks from tasks started with asyncio.gather take turns.
+    # Blocks nested inside one another in the same task just reuse it, which makes the lock reentrant. A block must not
+    # wait on other tasks that open their own block, they would wait for it forever.
+    @asynccontextmanager
+    async def use(self) -> AsyncIterator[AsyncSession]:
+        task = asyncio.current_task()
+
+        if self.owner is not task:
+            await self.lock.acquire()
+            self.owner = task
+
+        self.depth += 1
+
+        try:
+            if self.session is None:
+                self.session = session_factory()
+            yield self.session
+        finally:
+            self.depth -= 1
+
+            if self.depth == 0:
+                self.owner = None
+                self.lock.release()
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+_request_session: ContextVar[Optional[RequestSession]] = ContextVar("request_session", default=None)
+
+# Used as `async with async_session() as session:`. Inside a request this is the request's shared session so one request
+# never holds more than one connection, outside of one (loading, scripts) every block gets its own session.
+def async_session():
+    request_session = _request_session.get()
+
+    if request_session is None:
+        return session_factory()
+
+    return request_session.use()
+
+# Plain ASGI middleware that gives every request its RequestSession and closes it once the response has been sent,
+# which is after the last chunk for streamed responses
+class RequestSessionMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_session = RequestSession()
+        token = _request_session.set(request_session)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_session.reset(token)
+            await request_session.close()
 
 metadata = MetaData()
@@ -0,0 +1,93 @@
+import random
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+# The requests one browser session makes, in the same order and with the same parameters the frontend sends them
+# (see frontend/src/app/utils/services.ts and browser/NavigatableBar.tsx).
+
+# nucleotide bars are only requested below these window widths, the same constants as NavigatableBar.tsx
+NUCLEOTIDES_VIEW = 1000
+NUCLEOTIDES_LETTERS = 100
+
+# window widths visited while zooming in from the whole gene, the last two are where nucleotides are shown
+ZOOM_WIDTHS = [200000, 50000, 10000, 2000, 500, 80]
+
+# pans at every zoom level, as a fraction of the window width
+PANS = [0.5, -0.25]
+
+@dataclass
+class Request:
+    method: str
+    path: str
+    params: dict[str, Any]
+    body: Optional[Any] = None
+    # reported separately from the rest of the endpoint's requests when set
+    label: str = ""
+
+@dataclass
+class Session:
+    gene_name: str
+    steps: list[list[Request]] = field(default_factory=list)
+
+# Requests the frontend sends at the same time are one step, they are sent concurrently and the next step waits for them
+def gene_selection(gene_name: str, species_names: list[str]) -> list[Request]:
+    requests = [
+        Request("GET", "/genes/names", {}),
+        Request("GET", "/species/names", {}),
+        Request("GET", "/elements/all_TFBS", {"gene_name": gene_name}),
+        Request("GET", "/elements/all_variants", {"gene_name": gene_name}),
+        Request("GET", "/sequences/sequence_offsets", {"gene_name": gene_name}),
+        Request("GET", "/sequences/all_sequence_coordinates", {"gene_name": gene_name}),
+    ]
+
+    for species_name in species_names:
+        requests += [
+            Request("GET", "/species/assemblies", {"species_name": species_name}),
+            Request("GET", "/sequences/sequence_coordinate", {"gene_name": gene_name, "species_name": species_name}),
+            Request("GET", "/sequences/genomic_coordinate", {"gene_name": gene_name, "species_name": species_name}),
+        ]
+
+    return requests
+
+# Every track of one species' bar for the window
+def view(gene_name: str, species_name: str, start: int, end: int, TFBS: list[str], variants: list[str], label: str = "") -> list[Request]:
+    params = {"gene_name": gene_name, "species_name": species_name, "start": start, "end": end}
+
+    requests = [
+        Request("POST", "/elements/mapped_Variants", params, variants, label),
+        Request("POST", "/elements/mapped_TFBS", params, TFBS, label),
+        Request("POST", "/elements/mapped_Enh_Prom", params, ["Enh", "Prom"], label),
+    ]
+
+    if end - start <= NUCLEOTIDES_VIEW:
+        requests.append(Request("GET", "/sequences/mapped_nucleotides", {**params, "show_letters": end - start <= NUCLEOTIDES_LETTERS}, label=label))
+
+    return requests
+
+# gene selection, the whole region for every species (labelled since it costs far more than any zoomed in window), zooming in towards a random point of the gene with a couple of
+# pans at every level, and finally the conservation histograms
+def browser_session(gene_name: str, coordinates: dict[str, dict], gene_coordinates: dict[str, dict], TFBS: list[str], variants: list[str],
+                    rng: random.Random) -> Session:
+
+    session = Session(gene_name)
+    species_names = list(coordinates)
+
+    session.steps.append(gene_selection(gene_name, species_names))
+
+    session.steps.append([request for species_name in species_names
+                          for request in view(gene_name, species_name, coordinates[species_name]["start"], coordinates[species_name]["end"], TFBS, variants, "whole region")])
+
+    for species_name in species_names:
+        gene = gene_coordinates[species_name]
+        total = coordinates[species_name]
+        center = rng.randint(gene["start"], gene["end"])
+
+        for width in ZOOM_WIDTHS:
+            for pan in [0] + PANS:
+                start = max(total["start"], min(center - width // 2 + int(pan * width), total["end"] - width))
+                session.steps.append(view(gene_name, species_name, start, start + width, TFBS, variants))
+
+    session.steps.append([Request("GET", "/conservation_scores/histogram_data", {"gene_name": gene_name, "species_name": species_name})
+                          for species_name in species_names])
+
+    return session
@@ -0,0 +1,94 @@
+import asyncio
+import pytest
+from app import http_cache
+
+class App:
+
+    def __init__(self):
+        self.calls = []
+
+    # /genes/names answers 200 with the request body echoed back, anything else 404
+    async def __call__(self, scope, receive, send):
+        body = b""
+        if scope["method"] == "POST":
+            body = (await receive())["body"]
+
+        self.calls.append((scope["method"], scope["path"], body))
+
+        status = 200 if scope["path"] == "/genes/names" else 404
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": b"[" + body + b"]"})
+
+@pytest.fixture
+def app():
+    http_cache.set_dataset_version("v1")
+    yield App()
+    http_cache.set_dataset_version(None)
+
+def request(app, path: str, method: str = "GET", body: bytes = b"", if_none_match: bytes = None):
+    middleware = http_cache.ResponseCacheMiddleware(app)
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    headers = [(b"if-none-match", if_none_match)] if if_none_match is not None else []
+    asyncio.run(middleware({"type": "http", "method": method, "path": path, "query_string": b"", "headers": headers}, receive, send))
+
+    return sent[0]["status"], dict(sent[0]["headers"]), b"".join(message.get("body", b"") for message in sent[1:])
+
+def test_get_is_tagged_and_cached(app):
+    status, headers, body = request(app, "/genes/names")
+    assert (status, body) == (200, b"[]")
+    assert headers[b"etag"] == b'W/"v1"'
+    assert headers[b"vary"] == b"Accept-Encoding"
+
+    assert request(app, "/genes/names") == (status, headers, body)
+    assert len(app.calls) == 1
+
+def test_not_modified_only_for_success(app):
+    # answered by the handler the first time and from the cache after that
+    assert request(app, "/genes/names", if_none_match=b'W/"v1"')[0] == 304
+    assert request(app, "/genes/names", if_none_match=b'"v1"')[0] == 304
+    assert len(app.calls) == 1
+
+    # a URL that doesn't exist is never a 304, whatever version the client has
+    assert request(app, "/genes/missing", if_none_match=b'W/"v1"')[0] == 404
+    assert request(app, "/genes/missing", if_none_match=b"*")[0] == 404
+
+def test_other_version_is_sent_in_full(app):
+    status, _, body = request(app, "/genes/names", if_none_match=b'W/"v0"')
+    assert (status, body) == (200, b"[]")
+
+def test_post_body_is_part_of_the_key(app):
+    assert request(app, "/genes/names", "POST", b'"a"')[2] == b'["a"]'
+    assert request(app, "/genes/names", "POST", b'"b"')[2] == b'["b"]'
+    assert request(app, "/genes/names", "POST", b'"a"')[2] == b'["a"]'
+
+    assert app.calls == [("POST", "/genes/names", b'"a"'), ("POST", "/genes/names", b'"b"')]
+
+def test_new_dataset_version(app):
+    request(app, "/genes/names")
+    http_cache.set_dataset_version("v2")
+
+    # the old tag no longer matches and the cached response was dropped
+    status, headers, _ = request(app, "/genes/names", if_none_match=b'W/"v1"')
+    assert (status, headers[b"etag"]) == (200, b'W/"v2"')
+    assert len(app.calls) == 2
+
+def test_version_of_fingerprints():
+    assert http_cache.version_of({}) is None
+    assert http_cache.version_of({"Genes": "a", "Species": "b"}) == http_cache.version_of({"Species": "b", "Genes": "a"})
+    assert http_cache.version_of({"Genes": "a", "Species": "b"}) != http_cache.version_of({"Genes": "a", "Species": "c"})
+
+def test_nothing_is_cached_before_a_dataset_is_loaded(app):
+    http_cache.set_dataset_version(None)
+
+    status, headers, _ = request(app, "/genes/names")
+    assert status == 200 and b"etag" not in headers
+
+    request(app, "/genes/names")
+    assert len(app.calls) == 2
@@ -0,0 +1,52 @@
+import random
+import pytest
+from app.interval_index import IntervalIndex
+
+# the overlap rule of the sql query the index replaced
+def overlaps(row, start: int, end: int) -> bool:
+    return (start <= row[1] < end) or (start < row[2] <= end) or (row[1] <= start and row[2] >= end)
+
+def test_overlap_rule():
+    index = IntervalIndex([("Enh", 10, 20, 1), ("Prom", 20, 30, 1), ("Enh", 0, 100, 1), ("SNV", 25, 25, 1)])
+
+    assert index.overlapping(20, 25) == [("Enh", 0, 100, 1), ("Prom", 20, 30, 1), ("SNV", 25, 25, 1)]
+    # an element ending where the window starts doesn't overlap it, one starting where it ends doesn't either
+    assert index.overlapping(30, 40) == [("Enh", 0, 100, 1)]
+    assert index.overlapping(5, 10) == [("Enh", 0, 100, 1)]
+    assert index.overlapping(200, 300) == []
+
+def test_categories():
+    index = IntervalIndex([("Enh", 10, 20, 1), ("Prom", 12, 30, 1), ("Enh", 15, 16, 1)])
+
+    assert index.overlapping(0, 100, {"Enh"}) == [("Enh", 10, 20, 1), ("Enh", 15, 16, 1)]
+    assert index.overlapping(0, 100, set()) == []
+
+def test_rows_with_the_same_start_keep_their_order():
+    rows = [("B", 5, 10, 1), ("A", 5, 8, 1), ("C", 1, 10, 1), ("D", 5, 9, 1)]
+
+    assert IntervalIndex(rows).overlapping(0, 20) == [("C", 1, 10, 1), ("B", 5, 10, 1), ("A", 5, 8, 1), ("D", 5, 9, 1)]
+
+def test_empty():
+    assert IntervalIndex([]).overlapping(0, 100) == []
+
+@pytest.mark.parametrize("seed", range(5))
+def test_same_as_scanning_every_row(seed):
+    rnd = random.Random(seed)
+    rows = []
+    for _ in range(500):
+        start = rnd.randint(0, 10000)
+        rows.append((rnd.choice("ABC"), start, start + rnd.choice([0, rnd.randint(1, 50), rnd.randint(50, 5000)]), 1))
+
+    index = IntervalIndex(rows)
+    ordered = sorted(rows, key=lambda row: row[1])
+
+    for _ in range(300):
+        start = rnd.randint(-100, 10500)
+        end = start + rnd.randint(-20, 3000)
+        categories = rnd.choice([None, {"A"}, {"B", "C"}])
+
+        # like the sql query, the range check uses the window either way round but the rule above takes it as given
+        expected = [row for row in ordered if overlaps(row, start, end) and row[1] <= max(start, end) and row[2] >= min(start, end)
+                    and (categories is None or row[0] in categories)]
+
+        assert index.overlapping(start, end, categories) == expected, (start, end, categories)
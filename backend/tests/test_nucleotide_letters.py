@@ -0,0 +1,13 @@
+import json
+import pytest
+from app import packed
+from app.routers.regulatory_sequences import NucleotideSegment, letter_segments_json
+
+# lower case, N and a length whose widths don't come out round
+@pytest.mark.parametrize("sequence", ["", "A", "ACGTNacgtnRY", "GGGGA" * 61])
+def test_same_as_a_segment_per_base(sequence):
+    segments = [NucleotideSegment(type=base, width=(1 / len(sequence)) * 100) for base in sequence]
+
+    assert json.loads(letter_segments_json(sequence)) == [segment.model_dump() for segment in segments]
+    assert letter_segments_json(sequence) == json.dumps([segment.model_dump() for segment in segments], separators=(",", ":"))
+    assert packed.nucleotide_letters(sequence) == packed.nucleotide_segments(segments)
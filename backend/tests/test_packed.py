@@ -0,0 +1,122 @@
+import asyncio
+import gzip
+import struct
+from types import SimpleNamespace
+import pytest
+from app import compression, packed
+
+# Reads a packed body the way the browser does, following the layout documented in app/packed.py
+def decode(data: bytes) -> dict:
+    magic, version, kind, string_count, count, _ = packed.HEADER.unpack_from(data, 0)
+    assert magic == packed.MAGIC and version == packed.VERSION
+
+    offset = packed.HEADER.size
+    strings = []
+    for _ in range(string_count):
+        (length,) = struct.unpack_from("<H", data, offset)
+        strings.append(data[offset + 2:offset + 2 + length].decode())
+        offset += 2 + length
+    offset += -offset % 4
+
+    def column(typecode: str) -> list:
+        nonlocal offset
+        values = list(struct.unpack_from(f"<{count}{typecode}", data, offset))
+        offset += struct.calcsize(f"<{count}{typecode}")
+        # every section starts on a 4 byte boundary so typed arrays can be made over it
+        offset += -offset % 4
+        return values
+
+    def types() -> list[str]:
+        return [strings[index] for index in column("H")]
+
+    if kind == packed.SEQUENCE:
+        result = {"bases": data[offset:offset + count].decode("ascii")}
+        offset += count
+    elif kind == packed.BINNED:
+        start, end, bin_width = struct.unpack_from("<ddd", data, offset)
+        offset += 24
+        result = {"start": start, "end": end, "bin_width": bin_width, "types": types(), "counts": column("i")}
+    elif kind == packed.NUCLEOTIDE_SEGMENTS:
+        result = {"types": types(), "width": column("f")}
+    else:
+        result = {"types": types(), "chromosome": column("i"), "start": column("i"), "end": column("i")}
+        if kind == packed.SEGMENTS:
+            result["width"] = column("f")
+
+    assert offset == len(data), "trailing bytes"
+    assert len(data) % 4 == 0 or kind == packed.SEQUENCE
+
+    return {"kind": kind, **result}
+
+def test_elements():
+    element_list = [SimpleNamespace(type="Enhancer", chromosome=11, start=637269, end=637302),
+                    SimpleNamespace(type="Promoter", chromosome=11, start=-1, end=2 ** 31 - 1),
+                    SimpleNamespace(type="Enhancer", chromosome=1, start=0, end=0)]
+
+    assert decode(packed.elements(element_list)) == {"kind": packed.ELEMENTS,
+                                                    "types": ["Enhancer", "Promoter", "Enhancer"],
+                                                    "chromosome": [11, 11, 1],
+                                                    "start": [637269, -1, 0],
+                                                    "end": [637302, 2 ** 31 - 1, 0]}
+
+def test_segments_with_odd_string_lengths():
+    # the string table is 2 + 1 + 2 + 4 bytes long before it is padded, and the u16 type column 6 bytes
+    segment_list = [SimpleNamespace(type="a", chromosome=4, start=10, end=12, width=0.5),
+                    SimpleNamespace(type="βcd", chromosome=4, start=12, end=20, width=0.25),
+                    SimpleNamespace(type="a", chromosome=4, start=20, end=21, width=0.125)]
+
+    assert decode(packed.track(segment_list)) == {"kind": packed.SEGMENTS,
+                                                  "types": ["a", "βcd", "a"],
+                                                  "chromosome": [4, 4, 4],
+                                                  "start": [10, 12, 20],
+                                                  "end": [12, 20, 21],
+                                                  "width": [0.5, 0.25, 0.125]}
+
+def test_empty_segments():
+    assert decode(packed.segments([])) == {"kind": packed.SEGMENTS, "types": [], "chromosome": [], "start": [], "end": [], "width": []}
+
+def test_sequence():
+    assert decode(packed.sequence("ACGTNacgtn")) == {"kind": packed.SEQUENCE, "bases": "ACGTNacgtn"}
+
+def test_binned():
+    track = SimpleNamespace(start=100.0, end=612.5, bin_width=102.5, types=["gap", "Enhancer", "gap", "Promoter", "gap"], counts=[0, 3, 0, 1, 0])
+
+    assert decode(packed.track(track)) == {"kind": packed.BINNED, "start": 100.0, "end": 612.5, "bin_width": 102.5,
+                                           "types": ["gap", "Enhancer", "gap", "Promoter", "gap"], "counts": [0, 3, 0, 1, 0]}
+
+def test_nucleotide_segments():
+    segment_list = [SimpleNamespace(type="A", width=0.5), SimpleNamespace(type="T", width=0.5)]
+
+    assert decode(packed.nucleotide_segments(segment_list)) == {"kind": packed.NUCLEOTIDE_SEGMENTS, "types": ["A", "T"], "width": [0.5, 0.5]}
+
+# the packed body as it goes out over HTTP, compressed by the middleware for a client that accepts gzip
+@pytest.mark.parametrize("accept_encoding", [b"gzip", b"identity"])
+def test_compressed_response(accept_encoding):
+    element_list = [SimpleNamespace(type=f"type {i % 7}", chromosome=11, start=i * 10, end=i * 10 + 5) for i in range(1000)]
+    body = packed.elements(element_list)
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def run():
+        middleware = compression.CompressionMiddleware(packed.response(body))
+        await middleware({"type": "http", "method": "GET", "path": "/", "headers": [(b"accept-encoding", accept_encoding)]}, receive, send)
+
+    asyncio.run(run())
+
+    headers = dict(sent[0]["headers"])
+    received = b"".join(message.get("body", b"") for message in sent[1:])
+
+    assert headers[b"content-type"] == packed.MEDIA_TYPE.encode()
+
+    if accept_encoding == b"gzip":
+        assert headers[b"content-encoding"] == b"gzip"
+        received = gzip.decompress(received)
+
+    assert decode(received) == decode(body)
+    assert decode(received)["start"] == [i * 10 for i in range(1000)]
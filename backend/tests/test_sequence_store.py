@@ -0,0 +1,44 @@
+import pytest
+from app import sequence_store
+
+# N runs, soft masked runs, a masked N run and a length that isn't a multiple of 4 so the last byte is padded
+SEQUENCE = "acGTNNacgtTTGCAnnnCGTAgcRYtACGTNacg"
+
+# letters that aren't ACGT come back as N
+EXPECTED = "acGTNNacgtTTGCAnnnCGTAgcNNtACGTNacg"
+
+@pytest.fixture
+def stored(tmp_path, monkeypatch):
+    monkeypatch.setattr(sequence_store, "STORE_DIR", str(tmp_path))
+    sequence_store.reopen_files()
+
+    sequence_store.write_sequence("GENE", "Species", SEQUENCE)
+    yield sequence_store.open_sequence("GENE", "Species")
+
+    sequence_store.reopen_files()
+
+def test_pack_puts_the_first_base_in_the_highest_bits():
+    assert sequence_store.pack(b"TCAG") == bytes([0b00011011])
+    assert sequence_store.pack(b"GA") == bytes([0b11100000])
+    assert sequence_store.pack(b"gaNt") == bytes([0b11100000])
+
+def test_reads_every_range(stored):
+    assert len(stored) == len(SEQUENCE)
+
+    for start in range(len(SEQUENCE) + 1):
+        for end in range(start, len(SEQUENCE) + 1):
+            assert stored.read(start, end) == EXPECTED[start:end], (start, end)
+
+def test_clamps_like_slicing(stored):
+    for start, end in [(-5, 10), (10, 1000), (-1000, 1000), (20, 3), (-7, -2), (1000, 2000)]:
+        assert stored.read(start, end) == EXPECTED[start:end], (start, end)
+
+def test_rewriting_replaces_the_mapped_file(stored):
+    sequence_store.write_sequence("GENE", "Species", "TTTTA")
+
+    assert sequence_store.open_sequence("GENE", "Species").read(0, 10) == "TTTTA"
+
+def test_missing_sequence(tmp_path, monkeypatch):
+    monkeypatch.setattr(sequence_store, "STORE_DIR", str(tmp_path))
+
+    assert sequence_store.open_sequence("GENE", "Species") is None
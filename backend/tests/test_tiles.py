@@ -0,0 +1,53 @@
+import random
+import pytest
+from app.interval_index import IntervalIndex
+from app.routers.regulatory_elements import Element, bin_elements
+from app.tiles import TrackTiles
+
+CATEGORIES = ["Enh", "Prom", "TFBS", "SNV"]
+
+def random_rows(seed: int, count: int) -> list:
+    rnd = random.Random(seed)
+    rows = []
+
+    for _ in range(count):
+        start = rnd.randint(0, 20000)
+        # some zero length like variants and some long ones that cover many bins
+        length = rnd.choice([0, 1, rnd.randint(2, 40), rnd.randint(100, 3000)])
+        rows.append((rnd.choice(CATEGORIES), start, start + length, 11))
+
+    return rows
+
+# What /elements/mapped_* answers without tiles, from the elements the interval index finds in the window
+def exact(index: IntervalIndex, start: int, end: int, bins: int, categories: set[str]):
+    element_list = [Element(type=row[0], start=row[1], end=row[2], chromosome=row[3]) for row in index.overlapping(start, end, categories)]
+    track = bin_elements(start, end, element_list, bins)
+
+    return track.bin_width, track.types, track.counts
+
+def test_elements_outside_the_window_stay_out_of_the_edge_bins():
+    rows = [("Enh", 1000, 1010, 11), ("Prom", 3100, 3110, 11)]
+    index = IntervalIndex(rows)
+
+    assert TrackTiles(index.rows).binned(1020, 3090, 5, {"Enh", "Prom"}, "none") == (414.0, ["none"] * 5, [0] * 5)
+    assert exact(index, 1020, 3090, 5, {"Enh", "Prom"}) == (414.0, ["none"] * 5, [0] * 5)
+
+def test_ties_go_to_the_category_of_the_first_element():
+    rows = [("Prom", 0, 100, 11), ("Enh", 0, 100, 11), ("Enh", 150, 160, 11), ("Prom", 150, 160, 11)]
+    index = IntervalIndex(rows)
+
+    assert TrackTiles(index.rows).binned(0, 200, 4, {"Enh", "Prom"}, "none") == exact(index, 0, 200, 4, {"Enh", "Prom"})
+
+@pytest.mark.parametrize("seed", range(5))
+def test_same_bins_as_bin_elements(seed):
+    index = IntervalIndex(random_rows(seed, 600))
+    track_tiles = TrackTiles(index.rows)
+    rnd = random.Random(seed)
+
+    for _ in range(200):
+        start = rnd.randint(-500, 22000)
+        end = start + rnd.choice([1, 7, rnd.randint(10, 500), rnd.randint(500, 25000)])
+        bins = rnd.choice([1, 3, 5, 37, 100, 800])
+        categories = set(rnd.sample(CATEGORIES, rnd.randint(1, len(CATEGORIES)))) | {"missing"}
+
+        assert track_tiles.binned(start, end, bins, categories, "none") == exact(index, start, end, bins, categories), (start, end, bins, categories)
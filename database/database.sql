@@ -39,6 +39,7 @@ CREATE TABLE IF NOT EXISTS "ConservationScores" (
 	"phylop_score" DECIMAL NOT NULL,
 	"phastcon_score" DECIMAL NOT NULL,
 	"position" VARCHAR(255) NOT NULL,
+	"position_number" INTEGER NOT NULL,
 	PRIMARY KEY("id")
 );
 
@@ -94,6 +95,25 @@ CREATE TABLE IF NOT EXISTS "Variants" (
 
 
 
+
+CREATE TABLE IF NOT EXISTS "LoadedDatasets" (
+	"name" VARCHAR(255) NOT NULL,
+	"fingerprint" VARCHAR(64) NOT NULL,
+	"loaded_at" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+	PRIMARY KEY("name")
+);
+
+
+CREATE TABLE IF NOT EXISTS "LoadingDatasets" (
+	"name" VARCHAR(255) NOT NULL,
+	"state" VARCHAR(16) NOT NULL,
+	"updated_at" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+	"error" TEXT,
+	PRIMARY KEY("name")
+);
+
+
+
 ALTER TABLE "RegulatorySequences"
 ADD FOREIGN KEY("gene_id") REFERENCES "Genes"("id")
 ON UPDATE NO ACTION ON DELETE NO ACTION;
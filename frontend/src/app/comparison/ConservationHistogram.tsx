@@ -1,6 +1,7 @@
 'use client'
 
 import { useEffect, useState } from 'react';
+import { fetchHistogramData } from '../utils/services';
 
 interface HistogramProps {
   geneName: string;
@@ -32,15 +33,7 @@ export default function ConservationHistogram({ geneName, scoreType }: Histogram
       setError(null);
 
       try {
-        const response = await fetch(
-          `/api/conservation_scores/histogram_data?species_name=Homo%20sapiens&gene_name=${encodeURIComponent(geneName)}`
-        );
-
-        if (!response.ok) {
-          throw new Error(`HTTP ${response.status}`);
-        }
-
-        const jsonData = await response.json();
+        const jsonData = await fetchHistogramData(geneName, 'Homo sapiens');
         setData(jsonData);
       } catch (err) {
         console.error('Error fetching histogram data:', err);
@@ -4,6 +4,7 @@ import React, { useEffect, useState } from "react";
 import ConservationHistogram from "./ConservationHistogram";
 import {
   fetchGenes,
+  fetchHistogramData,
 } from "../utils/services";
 
 class LineShapes {
@@ -63,15 +64,7 @@ export default function RegComp() {
   async function downloadCSV(geneName: string) {
     setDownloading(geneName);
     try {
-      const response = await fetch(
-        `/api/conservation_scores/histogram_data?species_name=Homo%20sapiens&gene_name=${encodeURIComponent(geneName)}`
-      );
-
-      if (!response.ok) {
-        throw new Error(`HTTP ${response.status}`);
-      }
-
-      const data = await response.json();
+      const data = await fetchHistogramData(geneName, "Homo sapiens");
 
       // Convert JSON to CSV
       const csvHeader = 'Nucleotide,PhastCons Score,PhyloP Score\n';
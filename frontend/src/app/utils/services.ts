@@ -5,30 +5,56 @@
 // Always use /api to go through Next.js proxy (not direct to backend:8000)
 const API_BASE = "/api";
 
-// Small JSON fetch with timeout + retry
+// While the backend is still loading the data a request needs it answers 503 with a Retry-After header,
+// those are waited out for up to this long instead of counting as failed tries
+const LOADING_WAIT_MS = 120000;
+
+// Small JSON fetch with timeout + retry. Every failed attempt uses up one of the tries, answers saying the
+// data is still loading are waited out until LOADING_WAIT_MS has passed without using one up.
+// A timeoutMs of null lets every attempt run for as long as the request takes.
 async function fetchJSON(
   path: string,
   init: RequestInit = {},
   tries = 2,
-  timeoutMs = 10000
-) {
-  const ctrl = new AbortController();
-  const timer = setTimeout(() => ctrl.abort(), timeoutMs);
-
-  try {
-    const res = await fetch(`${API_BASE}${path}`, {
-      ...init,
-      signal: ctrl.signal,
-      cache: "no-store",
-    });
-    clearTimeout(timer);
-    if (!res.ok) throw new Error(`HTTP ${res.status} ${res.statusText}`);
+  timeoutMs: number | null = 10000
+): Promise<any> {
+  const loadingUntil = Date.now() + LOADING_WAIT_MS;
+  let lastError: unknown;
+
+  for (let attempt = 0; attempt <= tries; ) {
+    const ctrl = new AbortController();
+    const timer = timeoutMs === null ? undefined : setTimeout(() => ctrl.abort(), timeoutMs);
+    let res: Response;
+
+    try {
+      res = await fetch(`${API_BASE}${path}`, {
+        ...init,
+        signal: ctrl.signal,
+        cache: "no-store",
+      });
+    } catch (err) {
+      lastError = err;
+      attempt++;
+      continue;
+    } finally {
+      clearTimeout(timer);
+    }
+
+    if (res.status === 503 && Date.now() < loadingUntil) {
+      const seconds = Number(res.headers.get("Retry-After")) || 1;
+      const wait = Math.min(seconds * 1000, loadingUntil - Date.now());
+      await new Promise((resolve) => setTimeout(resolve, wait));
+      continue;
+    }
+    if (!res.ok) {
+      lastError = new Error(`HTTP ${res.status} ${res.statusText}`);
+      attempt++;
+      continue;
+    }
     return res.json();
-  } catch (err) {
-    clearTimeout(timer);
-    if (tries > 0) return fetchJSON(path, init, tries - 1, timeoutMs);
-    throw err;
   }
+
+  throw lastError;
 }
 
 /** Fetch all gene names */
@@ -147,6 +173,12 @@ export async function fetchNucleotideBar(geneName: string, speciesName: string,
   return fetchJSON(`/sequences/mapped_nucleotides?gene_name=${encodeURIComponent(geneName)}&species_name=${encodeURIComponent(speciesName)}&start=${encodeURIComponent(start)}&end=${encodeURIComponent(end)}&show_letters=${encodeURIComponent(showLetters)}`);
 } 
 
+/** Conservation scores and nucleotide of every position of a gene for one species */
+export async function fetchHistogramData(geneName: string, speciesName: string) {
+  // a whole gene can take longer than the usual timeout to come back, so these requests have none
+  return fetchJSON(`/conservation_scores/histogram_data?species_name=${encodeURIComponent(speciesName)}&gene_name=${encodeURIComponent(geneName)}`, {}, 2, null);
+}
+
 
 
 /**